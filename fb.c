@@ -1,12 +1,18 @@
 // Framebuffer I/O, because pure python is waaaay too slow
 #include <stdlib.h>
 #include <stdint.h>
+#include <string.h>
 #include <unistd.h>
 #include <sys/ioctl.h>
 #include <sys/mman.h>
 #include <fcntl.h>
 #include <errno.h>
 #include <linux/fb.h>
+#include <pthread.h>
+#include <signal.h>
+
+#define MAX_THREADS 8               // most threads used to pack or unpack a rectangle
+#define THREAD_PIXELS (256*1024)    // don't use threads for fewer pixels than this
 
 struct fbinfo
 {
@@ -15,8 +21,15 @@ struct fbinfo
              bpp,       // bytes per pixel: 2, 3, or 4. If 2 bytes, then colorspace is 565.
              red,       // red shift
              green,     // green shift
-             blue;      // blue shift
-    void   * mmap;      // pointer to frame buffer memory
+             blue,      // blue shift
+             stride;    // bytes per line, at least width*bpp
+    void   * mmap;      // pointer to frame buffer memory to draw into
+    void   * visible;   // pointer to frame buffer memory being displayed
+    int32_t  fd;        // device handle, for panning and vsync
+    uint32_t yoffset,   // offset of the visible page in the virtual frame buffer
+             yvirtual,  // virtual height in pixels
+             buffering, // 0 = single, 1 = page flipping, 2 = shadow buffer
+             threads;   // max threads for large rectangles, 1 = don't use threads
 };
 
 int fbopen(struct fbinfo *fb, char *device)
@@ -25,7 +38,8 @@ int fbopen(struct fbinfo *fb, char *device)
     if (fd < 0) return 1;
 
     struct fb_var_screeninfo vsi;
-    if (ioctl(fd, FBIOGET_VSCREENINFO, &vsi) < 0)
+    struct fb_fix_screeninfo fsi;
+    if (ioctl(fd, FBIOGET_VSCREENINFO, &vsi) < 0 || ioctl(fd, FBIOGET_FSCREENINFO, &fsi) < 0)
     {
         close(fd);
         return 2;
@@ -51,37 +65,186 @@ int fbopen(struct fbinfo *fb, char *device)
         return 3;
     }
 
-    fb->height = vsi.yres_virtual;
-    fb->width = vsi.xres_virtual;
+    fb->height = vsi.yres;
+    fb->width = vsi.xres;
     fb->red = vsi.red.offset;
     fb->green = vsi.green.offset;
     fb->blue = vsi.blue.offset;
+    // some drivers don't report line length
+    fb->stride = fsi.line_length >= vsi.xres_virtual * fb->bpp ? fsi.line_length : vsi.xres_virtual * fb->bpp;
 
-    fb->mmap=mmap(NULL, vsi.xres_virtual * vsi.yres_virtual * fb->bpp, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
-    close(fd);
-
-    if (fb->mmap == MAP_FAILED)
+    // map the entire virtual frame buffer
+    uint8_t *m = mmap(NULL, fb->stride * vsi.yres_virtual, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+    if (m == MAP_FAILED)
     {
+        close(fd);
         return 4;
     }
 
+    // but draw into whatever is visible
+    fb->mmap = fb->visible = m + (vsi.yoffset * fb->stride) + (vsi.xoffset * fb->bpp);
+    fb->fd = fd;
+    fb->yoffset = vsi.yoffset;
+    fb->yvirtual = vsi.yres_virtual;
+    fb->buffering = 0;
+    long cpus = sysconf(_SC_NPROCESSORS_ONLN);
+    fb->threads = cpus < 1 ? 1 : cpus > MAX_THREADS ? MAX_THREADS : cpus;
     return 0;
 }
 
-// Unpack pixels from framebuffer pixel offset to raw rgb data and return 0.
-// Return 1 if pixels+offset is out of range. *rgfb size must be pixels*3 bytes
-int fbunpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
+// Enable double buffering and return 0. If the virtual frame buffer has room
+// for a second page then draw into that and pan to it with fbflip(),
+// otherwise draw into a shadow buffer and copy it with fbflip(). Either way,
+// the draw buffer starts with a copy of the visible page. Return 1 if the
+// shadow buffer can't be allocated.
+int fbdouble(struct fbinfo *fb)
+{
+    if (fb->buffering) return 0;
+
+    if (fb->yvirtual >= fb->height * 2 && !(fb->yoffset % fb->height))
+    {
+        // draw into the next page, wrapping to the first
+        uint8_t *base = (uint8_t *)fb->visible - (fb->yoffset * fb->stride);
+        uint32_t yoffset = fb->yoffset + fb->height;
+        if (yoffset + fb->height > fb->yvirtual) yoffset = 0;
+        fb->mmap = base + (yoffset * fb->stride);
+        fb->buffering = 1;
+    }
+    else
+    {
+        fb->mmap = malloc(fb->height * fb->stride);
+        if (!fb->mmap)
+        {
+            fb->mmap = fb->visible;
+            return 1;
+        }
+        fb->buffering = 2;
+    }
+    memcpy(fb->mmap, fb->visible, fb->height * fb->stride);
+    return 0;
+}
+
+// Make the draw buffer visible and return 0. If page flipping, pan to the draw
+// page then wait for vsync, and draw into the page that was visible. If
+// shadow buffering, wait for vsync then copy the given rows of the shadow
+// buffer to the frame buffer. Return 1 if pan fails. Does nothing if not
+// double buffering.
+int fbflip(struct fbinfo *fb, uint32_t first, uint32_t rows)
+{
+    uint32_t zero = 0;
+
+    switch(fb->buffering)
+    {
+        case 1:
+        {
+            struct fb_var_screeninfo vsi;
+            if (ioctl(fb->fd, FBIOGET_VSCREENINFO, &vsi) < 0) return 1;
+            uint8_t *base = (uint8_t *)fb->visible - (fb->yoffset * fb->stride);
+            vsi.yoffset = ((uint8_t *)fb->mmap - base) / fb->stride;
+            if (ioctl(fb->fd, FBIOPAN_DISPLAY, &vsi) < 0) return 1;
+            ioctl(fb->fd, FBIO_WAITFORVSYNC, &zero); // not all drivers support this
+            void *p = fb->visible;
+            fb->visible = fb->mmap;
+            fb->mmap = p;
+            fb->yoffset = vsi.yoffset;
+            break;
+        }
+        case 2:
+        {
+            if (first >= fb->height) break;
+            if (first + rows > fb->height) rows = fb->height - first;
+            ioctl(fb->fd, FBIO_WAITFORVSYNC, &zero);
+            memcpy((uint8_t *)fb->visible + (first * fb->stride), (uint8_t *)fb->mmap + (first * fb->stride), rows * fb->stride);
+            break;
+        }
+    }
+    return 0;
+}
+
+// Return pointer to framebuffer memory for pixel x, y
+static inline uint8_t *pixel(struct fbinfo *fb, uint32_t x, uint32_t y)
+{
+    return (uint8_t *)fb->mmap + (y * fb->stride) + (x * fb->bpp);
+}
+
+// Fast paths for the common layouts. The shifts are constant and the loops
+// are simple, so the compiler can vectorise them.
+
+// 32-bit XRGB, red 16, green 8, blue 0
+static void pack_xrgb(uint32_t *restrict p, uint32_t pixels, const uint8_t *restrict rgb)
+{
+    for (size_t i = 0; i < pixels; i++)
+        p[i] = 0xff000000u | ((uint32_t)rgb[i*3] << 16) | ((uint32_t)rgb[i*3+1] << 8) | rgb[i*3+2];
+}
+
+static void unpack_xrgb(const uint32_t *restrict p, uint32_t pixels, uint8_t *restrict rgb)
+{
+    for (size_t i = 0; i < pixels; i++)
+    {
+        uint32_t n = p[i];
+        rgb[i*3] = n >> 16;
+        rgb[i*3+1] = n >> 8;
+        rgb[i*3+2] = n;
+    }
+}
+
+// 24-bit BGR, red 16, green 8, blue 0
+static void pack_bgr(uint8_t *restrict p, uint32_t pixels, const uint8_t *restrict rgb)
 {
-    if (offset+pixels > fb->height*fb->width) return 1;
+    for (size_t i = 0; i < pixels; i++)
+    {
+        p[i*3] = rgb[i*3+2];
+        p[i*3+1] = rgb[i*3+1];
+        p[i*3+2] = rgb[i*3];
+    }
+}
+
+static void unpack_bgr(const uint8_t *restrict p, uint32_t pixels, uint8_t *restrict rgb)
+{
+    pack_bgr(rgb, pixels, p); // same swap
+}
 
+// 16-bit RGB565, red 11, green 5, blue 0
+static void pack_565(uint16_t *restrict p, uint32_t pixels, const uint8_t *restrict rgb)
+{
+    for (size_t i = 0; i < pixels; i++)
+        p[i] = ((rgb[i*3] >> 3) << 11) | ((rgb[i*3+1] >> 2) << 5) | (rgb[i*3+2] >> 3);
+}
+
+static void unpack_565(const uint16_t *restrict p, uint32_t pixels, uint8_t *restrict rgb)
+{
+    for (size_t i = 0; i < pixels; i++)
+    {
+        uint16_t n = p[i];
+        rgb[i*3] = (n >> 11) << 3;
+        rgb[i*3+1] = (n >> 5) << 2;
+        rgb[i*3+2] = n << 3;
+    }
+}
+
+// Return true if the framebuffer has the given shifts
+static inline int layout(struct fbinfo *fb, uint32_t red, uint32_t green, uint32_t blue)
+{
+    return fb->red == red && fb->green == green && fb->blue == blue;
+}
+
+// Unpack pixels from framebuffer memory at *p to raw rgb data, pixels must not
+// extend past the end of the line.
+static void unpack(struct fbinfo *fb, uint8_t *p, uint32_t pixels, uint8_t *rgb)
+{
     switch(fb->bpp)
     {
         case 2:
         {
-            uint16_t *p = fb->mmap+(offset*2);
+            if (layout(fb, 11, 5, 0))
+            {
+                unpack_565((uint16_t *)p, pixels, rgb);
+                break;
+            }
+            uint16_t *p16 = (uint16_t *)p;
             while (pixels--)
             {
-                uint16_t n = *p++;
+                uint16_t n = *p16++;
                 *rgb++ = (n >> fb->red) << 3;
                 *rgb++ = (n >> fb->green) << 2;
                 *rgb++ = (n >> fb->blue) << 3;
@@ -90,22 +253,37 @@ int fbunpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
         }
         case 3:
         {
-            uint8_t *p = fb->mmap+(offset*3);
+            if (layout(fb, 16, 8, 0))
+            {
+                unpack_bgr(p, pixels, rgb);
+                break;
+            }
+            if (layout(fb, 0, 8, 16))
+            {
+                memcpy(rgb, p, pixels*3);
+                break;
+            }
             while (pixels--)
             {
-                uint32_t n = (*p++ << 0) + (*p++ << 8) + (*p++ << 16); // little-endian
+                uint32_t n = p[0] | (p[1] << 8) | (p[2] << 16); // little-endian
+                p += 3;
                 *rgb++ = n >> fb->red;
                 *rgb++ = n >> fb->green;
                 *rgb++ = n >> fb->blue;
-
             }
+            break;
         }
         case 4:
         {
-            uint32_t *p = fb->mmap+(offset*4);
+            uint32_t *p32 = (uint32_t *)p;
+            if (layout(fb, 16, 8, 0))
+            {
+                unpack_xrgb(p32, pixels, rgb);
+                break;
+            }
             while (pixels--)
             {
-                uint32_t n = *p++;
+                uint32_t n = *p32++;
                 *rgb++ = n >> fb->red;
                 *rgb++ = n >> fb->green;
                 *rgb++ = n >> fb->blue;
@@ -113,31 +291,41 @@ int fbunpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
             break;
         }
     }
-    return 0;
 }
 
-// Pack pixels of raw rgb data to framebuffer specified pixel offset and return
-// 0. Error ERANGE if pixels+offset out of range. *rgb must be pixels*3 bytes
-// long.
-int fbpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
+// Pack pixels of raw rgb data to framebuffer memory at *p, pixels must not
+// extend past the end of the line.
+static void pack(struct fbinfo *fb, uint8_t *p, uint32_t pixels, uint8_t *rgb)
 {
-    if (offset+pixels > fb->height*fb->width) return 1;
-
     switch(fb->bpp)
     {
         case 2:
         {
-            uint16_t *p = fb->mmap+(offset*2);
+            uint16_t *p16 = (uint16_t *)p;
+            if (layout(fb, 11, 5, 0))
+            {
+                pack_565(p16, pixels, rgb);
+                break;
+            }
             while (pixels--)
             {
-                *p++ = ((rgb[0]>>3) << fb->red) | ((rgb[1]>>2) << fb->green) | ((rgb[2]>>3) << fb->blue);
+                *p16++ = ((rgb[0]>>3) << fb->red) | ((rgb[1]>>2) << fb->green) | ((rgb[2]>>3) << fb->blue);
                 rgb += 3;
             }
             break;
         }
         case 3:
         {
-            uint8_t *p = fb->mmap+(offset*3);
+            if (layout(fb, 16, 8, 0))
+            {
+                pack_bgr(p, pixels, rgb);
+                break;
+            }
+            if (layout(fb, 0, 8, 16))
+            {
+                memcpy(p, rgb, pixels*3);
+                break;
+            }
             while (pixels--)
             {
                 uint32_t n = (rgb[0] << fb->red) | (rgb[1] << fb->green) | (rgb[2] << fb->blue);
@@ -148,15 +336,352 @@ int fbpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
         }
         case 4:
         {
-            uint32_t *p = fb->mmap+(offset*4);
-
+            uint32_t *p32 = (uint32_t *)p;
+            if (layout(fb, 16, 8, 0))
+            {
+                pack_xrgb(p32, pixels, rgb);
+                break;
+            }
+            // set the unused byte, whichever it is
+            uint32_t x = ~((0xffu << fb->red) | (0xffu << fb->green) | (0xffu << fb->blue));
             while (pixels--)
             {
-                *p++ = (rgb[0] << fb->red) | (rgb[1] << fb->green) | (rgb[2] << fb->blue) | 0xff000000;
+                *p32++ = (rgb[0] << fb->red) | (rgb[1] << fb->green) | (rgb[2] << fb->blue) | x;
                 rgb += 3;
             }
             break;
         }
     }
+}
+
+// A band of rows to pack or unpack
+struct band
+{
+    struct fbinfo *fb;
+    uint32_t x, y, w, h, stride;
+    uint8_t *rgb;
+    void (*convert)(struct fbinfo *, uint8_t *, uint32_t, uint8_t *); // pack or unpack
+};
+
+static void convert_band(struct band *b)
+{
+    uint8_t *rgb = b->rgb;
+    for (uint32_t y = b->y; y < b->y + b->h; y++)
+    {
+        b->convert(b->fb, pixel(b->fb, b->x, y), b->w, rgb);
+        rgb += b->stride;
+    }
+}
+
+// Worker threads that convert bands, started when first needed and shared by
+// all framebuffers. One rectangle is converted at a time.
+static struct
+{
+    pthread_mutex_t busy,   // held while a rectangle is being converted
+                    lock;   // protects the rest
+    pthread_cond_t work,    // signalled when there are bands to convert
+                   done;    // signalled when the last band is converted
+    uint32_t workers;       // threads started
+    struct band *bands;     // bands of the rectangle being converted
+    uint32_t count,         // number of bands
+             next,          // next band to convert
+             pending;       // bands not converted yet
+} pool = { .busy = PTHREAD_MUTEX_INITIALIZER, .lock = PTHREAD_MUTEX_INITIALIZER, .work = PTHREAD_COND_INITIALIZER, .done = PTHREAD_COND_INITIALIZER };
+
+// Convert bands until there are none left, with pool.lock held
+static void convert_bands(void)
+{
+    while (pool.next < pool.count)
+    {
+        struct band *b = &pool.bands[pool.next++];
+        pthread_mutex_unlock(&pool.lock);
+        convert_band(b);
+        pthread_mutex_lock(&pool.lock);
+        if (!--pool.pending) pthread_cond_signal(&pool.done);
+    }
+}
+
+static void *worker(void *arg)
+{
+    (void)arg;
+    pthread_mutex_lock(&pool.lock);
+    while (1)
+    {
+        while (pool.next >= pool.count) pthread_cond_wait(&pool.work, &pool.lock);
+        convert_bands();
+    }
+    return NULL;
+}
+
+// After fork() the child has no workers
+static void forked(void)
+{
+    pthread_mutex_init(&pool.busy, NULL);
+    pthread_mutex_init(&pool.lock, NULL);
+    pthread_cond_init(&pool.work, NULL);
+    pthread_cond_init(&pool.done, NULL);
+    pool.workers = pool.count = pool.next = pool.pending = 0;
+}
+
+static void register_forked(void)
+{
+    pthread_atfork(NULL, NULL, forked);
+}
+
+// Start workers until there are 'threads', with pool.lock held. They don't
+// take signals, those are for the main thread. Returns the number running.
+static uint32_t start_workers(uint32_t threads)
+{
+    static pthread_once_t once = PTHREAD_ONCE_INIT;
+    pthread_once(&once, register_forked);
+    sigset_t all, old;
+    sigfillset(&all);
+    pthread_sigmask(SIG_SETMASK, &all, &old);
+    while (pool.workers < threads)
+    {
+        pthread_t thread;
+        if (pthread_create(&thread, NULL, worker, NULL)) break;
+        pthread_detach(thread);
+        pool.workers++;
+    }
+    pthread_sigmask(SIG_SETMASK, &old, NULL);
+    return pool.workers;
+}
+
+// Pack or unpack the w x h rectangle at x, y, rows of rgb data are stride
+// bytes apart, if 0 then every row gets the same data (e.g. a fill color).
+// If there are enough pixels then split the rows into bands and convert them
+// in parallel, in this thread and up to fb->threads-1 workers. If another
+// thread is already using the workers then just convert it here.
+static void convert_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint32_t stride, uint8_t *rgb,
+                         void (*convert)(struct fbinfo *, uint8_t *, uint32_t, uint8_t *))
+{
+    struct band bands[MAX_THREADS];
+    uint32_t threads = fb->threads;
+    if (threads > MAX_THREADS) threads = MAX_THREADS;
+    if (threads > h) threads = h;
+    if ((uint64_t)w * h < THREAD_PIXELS || !threads || pthread_mutex_trylock(&pool.busy)) threads = 1;
+
+    if (threads == 1)
+    {
+        bands[0] = (struct band){ .fb = fb, .x = x, .y = y, .w = w, .h = h, .stride = stride, .rgb = rgb, .convert = convert };
+        convert_band(&bands[0]);
+        return;
+    }
+
+    for (uint32_t i = 0; i < threads; i++)
+    {
+        uint32_t first = (uint64_t)h * i / threads, last = (uint64_t)h * (i+1) / threads;
+        bands[i] = (struct band){ .fb = fb, .x = x, .y = y + first, .w = w, .h = last - first,
+                                  .stride = stride, .rgb = rgb + ((size_t)first * stride), .convert = convert };
+    }
+    pthread_mutex_lock(&pool.lock);
+    // this thread converts bands too, and any the workers don't get to
+    if (pool.workers < threads-1) start_workers(threads-1);
+    pool.bands = bands;
+    pool.count = pool.pending = threads;
+    pool.next = 0;
+    pthread_cond_broadcast(&pool.work);
+    convert_bands();
+    while (pool.pending) pthread_cond_wait(&pool.done, &pool.lock);
+    pool.count = pool.next = 0;
+    pthread_mutex_unlock(&pool.lock);
+    pthread_mutex_unlock(&pool.busy);
+}
+
+// Pack or unpack pixels starting at framebuffer pixel offset, a partial line
+// then whole lines then a partial line.
+static void convert_pixels(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb,
+                           void (*convert)(struct fbinfo *, uint8_t *, uint32_t, uint8_t *))
+{
+    uint32_t x = offset % fb->width, y = offset / fb->width;
+    if (x && pixels)
+    {
+        uint32_t n = fb->width - x;
+        if (n > pixels) n = pixels;
+        convert(fb, pixel(fb, x, y++), n, rgb);
+        rgb += n*3;
+        pixels -= n;
+    }
+    if (pixels >= fb->width)
+    {
+        uint32_t h = pixels / fb->width;
+        convert_rect(fb, 0, y, fb->width, h, fb->width*3, rgb, convert);
+        rgb += (size_t)h * fb->width * 3;
+        pixels -= h * fb->width;
+        y += h;
+    }
+    if (pixels) convert(fb, pixel(fb, 0, y), pixels, rgb);
+}
+
+// Unpack pixels from framebuffer pixel offset to raw rgb data and return 0.
+// Return 1 if pixels+offset is out of range. *rgb size must be pixels*3 bytes
+int fbunpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
+{
+    if (offset+pixels > fb->height*fb->width || offset+pixels < offset) return 1;
+    convert_pixels(fb, pixels, offset, rgb, unpack);
+    return 0;
+}
+
+// Pack pixels of raw rgb data to framebuffer specified pixel offset and return
+// 0. Return 1 if pixels+offset out of range. *rgb must be pixels*3 bytes
+// long.
+int fbpack(struct fbinfo *fb, uint32_t pixels, uint32_t offset, uint8_t *rgb)
+{
+    if (offset+pixels > fb->height*fb->width || offset+pixels < offset) return 1;
+    convert_pixels(fb, pixels, offset, rgb, pack);
+    return 0;
+}
+
+// Unpack the w x h rectangle of framebuffer pixels at x, y to raw rgb data and
+// return 0. Return 1 if the rectangle is out of range. Rows of *rgb are
+// src_stride bytes apart, or w*3 if src_stride is 0.
+int fbunpack_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint32_t src_stride, uint8_t *rgb)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    if (!src_stride) src_stride = w*3;
+    convert_rect(fb, x, y, w, h, src_stride, rgb, unpack);
+    return 0;
+}
+
+// Pack the w x h rectangle of raw rgb data to framebuffer pixels at x, y and
+// return 0. Return 1 if the rectangle is out of range. Rows of *rgb are
+// src_stride bytes apart, or w*3 if src_stride is 0.
+int fbpack_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint32_t src_stride, uint8_t *rgb)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    if (!src_stride) src_stride = w*3;
+    convert_rect(fb, x, y, w, h, src_stride, rgb, pack);
+    return 0;
+}
+
+// Copy the w x h rectangle of data that is already in the native pixel format
+// to framebuffer pixels at x, y and return 0. Return 1 if the rectangle is out
+// of range. Rows of *data are src_stride bytes apart, or w*bpp if src_stride
+// is 0.
+int fbwrite_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint32_t src_stride, uint8_t *data)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    if (!w || !h) return 0;
+    size_t n = (size_t)w * fb->bpp;
+    if (!src_stride) src_stride = n;
+    uint8_t *p = pixel(fb, x, y);
+    if (n == src_stride && n == fb->stride)
+        // whole lines
+        memcpy(p, data, n * h);
+    else
+        for (uint32_t i = 0; i < h; i++) memcpy(p + ((size_t)i * fb->stride), data + ((size_t)i * src_stride), n);
+    return 0;
+}
+
+// Move the w x h rectangle of framebuffer pixels at x, y to x+dx, y+dy and
+// return 0, the source and destination can overlap. Return 1 if either
+// rectangle is out of range.
+int fbcopy_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, int32_t dx, int32_t dy)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    if ((int64_t)x+dx < 0 || (int64_t)x+dx+w > fb->width || (int64_t)y+dy < 0 || (int64_t)y+dy+h > fb->height) return 1;
+    if (!w || !h) return 0;
+    uint8_t *src = pixel(fb, x, y), *dst = pixel(fb, x+dx, y+dy);
+    size_t n = (size_t)w * fb->bpp;
+    if (n == fb->stride)
+        // whole lines
+        memmove(dst, src, n * h);
+    else if (dy > 0)
+        // moving down, start at the bottom
+        for (uint32_t i = h; i--;) memmove(dst + (i * fb->stride), src + (i * fb->stride), n);
+    else
+        for (uint32_t i = 0; i < h; i++) memmove(dst + (i * fb->stride), src + (i * fb->stride), n);
+    return 0;
+}
+
+// Fill pixels of framebuffer memory at *p with the color rgb[0..2], pixels
+// must not extend past the end of the line.
+static void fill(struct fbinfo *fb, uint8_t *p, uint32_t pixels, uint8_t *rgb)
+{
+    if (!pixels) return;
+    pack(fb, p, 1, rgb);
+    size_t size = (size_t)pixels * fb->bpp;
+    for (size_t n = fb->bpp; n < size; n *= 2) memcpy(p + n, p, n < size - n ? n : size - n);
+}
+
+// Blend pixels of framebuffer memory at *p with the color rgba[0..2], by
+// opacity rgba[3], pixels must not extend past the end of the line.
+static void blend(struct fbinfo *fb, uint8_t *p, uint32_t pixels, uint8_t *rgba)
+{
+    uint8_t rgb[256*3];
+    uint32_t a = rgba[3], c[3] = { rgba[0] * a + 127, rgba[1] * a + 127, rgba[2] * a + 127 };
+    while (pixels)
+    {
+        uint32_t n = pixels < 256 ? pixels : 256;
+        unpack(fb, p, n, rgb);
+        for (uint32_t i = 0; i < n*3; i += 3)
+            for (int j = 0; j < 3; j++) rgb[i+j] = (rgb[i+j] * (255 - a) + c[j]) / 255;
+        pack(fb, p, n, rgb);
+        p += n * fb->bpp;
+        pixels -= n;
+    }
+}
+
+// Fill the w x h rectangle of framebuffer pixels at x, y with the color
+// rgb[0..2] and return 0. Return 1 if the rectangle is out of range.
+int fbfill_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint8_t *rgb)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    convert_rect(fb, x, y, w, h, 0, rgb, fill);
+    return 0;
+}
+
+// Blend the w x h rectangle of framebuffer pixels at x, y with the color
+// rgba[0..2], by opacity rgba[3] (255 is the same as fill), and return 0.
+// Return 1 if the rectangle is out of range.
+int fbblend_rect(struct fbinfo *fb, uint32_t x, uint32_t y, uint32_t w, uint32_t h, uint8_t *rgba)
+{
+    if (x+w > fb->width || y+h > fb->height || x+w < x || y+h < y) return 1;
+    convert_rect(fb, x, y, w, h, 0, rgba, blend);
+    return 0;
+}
+
+// Return hash h updated with len bytes at p. Each step is a bijection of h,
+// so changing any one 8-byte word always changes the result.
+static inline uint64_t hash(uint64_t h, const uint8_t *p, size_t len)
+{
+    uint64_t w;
+    for (; len >= 8; len -= 8, p += 8)
+    {
+        memcpy(&w, p, 8);
+        h = (h ^ w) * 0x9e3779b97f4a7c15ull;
+    }
+    if (len)
+    {
+        w = 0;
+        memcpy(&w, p, len);
+        h = (h ^ w) * 0x9e3779b97f4a7c15ull;
+    }
+    return h;
+}
+
+// Hash each size x size tile of framebuffer pixels into hashes[], which is
+// in rows of (width+size-1)/size tiles, and return 0. Hashes are only useful
+// to find which tiles changed. Return 1 if size is 0.
+int fbhash(struct fbinfo *fb, uint32_t size, uint64_t *hashes)
+{
+    if (!size) return 1;
+    uint32_t columns = (fb->width + size - 1) / size;
+    size_t n = (size_t)size * fb->bpp;
+    for (uint32_t y = 0; y < fb->height; y++)
+    {
+        uint64_t *h = hashes + (size_t)(y / size) * columns;
+        if (!(y % size)) memset(h, 0, columns * sizeof(uint64_t));
+        const uint8_t *p = pixel(fb, 0, y);
+        size_t left = (size_t)fb->width * fb->bpp;
+        for (uint32_t c = 0; c < columns; c++)
+        {
+            size_t len = left < n ? left : n;
+            h[c] = hash(h[c], p, len);
+            p += len;
+            left -= len;
+        }
+    }
     return 0;
 }
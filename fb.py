@@ -1,29 +1,123 @@
 # python interface to fb.bin
-import os
+import os, sys, array
 from ctypes import *
 
-# directory that contains this module must also contain fb.bin
+# directory that contains this module should also contain fb.bin
 _fb_bin=(os.path.dirname(__file__) or '.')+"/fb.bin"
-if not os.path.isfile(_fb_bin):
-    raise Exception("Can't find %s\n"
-        "Most likely this is because you didn't build it.\n"
-        "Go to the fbtools directory and run 'make'." % _fb_bin)
+
+# Framebuffer backend, "c" to use fb.bin or "numpy" to use fbnumpy.py. Default
+# is "c" if fb.bin has been built, environment FB_BACKEND overrides.
+backend = os.environ.get("FB_BACKEND") or ("c" if os.path.isfile(_fb_bin) else "numpy")
+
+# Same as struct fbinfo in fb.c
+class fbinfo(Structure):
+    _fields_ = [
+        ("height", c_uint32),     # height in pixels
+        ("width", c_uint32),      # width in pixels
+        ("bpp", c_uint32),        # bytes per pixel
+        ("red", c_uint32),        # red shift
+        ("green", c_uint32),      # green shift
+        ("blue", c_uint32),       # blue shift
+        ("stride", c_uint32),     # bytes per line
+        ("mmap", c_void_p),       # pointer to frame buffer memory to draw into
+        ("visible", c_void_p),    # pointer to frame buffer memory being displayed
+        ("fd", c_int32),          # device handle
+        ("yoffset", c_uint32),    # offset of the visible page
+        ("yvirtual", c_uint32),   # virtual height in pixels
+        ("buffering", c_uint32),  # 0 = single, 1 = page flipping, 2 = shadow buffer
+        ("threads", c_uint32),    # max threads for large rectangles, 1 = don't use threads
+    ]
+
+# Given an object that supports the buffer protocol, return something that can
+# be passed to fb.bin as a pointer to at least 'size' bytes.
+def _pointer(data, size, writable=False):
+    m = memoryview(data).cast('B')
+    if m.nbytes < size: raise Exception("Buffer has %d bytes, need %d" % (m.nbytes, size))
+    if not m.readonly: return (c_char * m.nbytes).from_buffer(m)
+    if writable: raise Exception("Buffer is read-only")
+    if type(data) is bytes: return data
+    return bytes(m) # have to copy it
+
+# Return the PIL raw mode that describes the native pixel layout, e.g. "BGRA"
+# for 32-bit XRGB. The unused byte of a 4-byte pixel is named 'A' since fbpack
+# sets it to 0xff. Return None if there is no equivalent raw mode.
+def _rawmode(bpp, red, green, blue):
+    if bpp not in (3, 4): return None
+    mode = ['A'] * bpp
+    for c, shift in (('R', red), ('G', green), ('B', blue)):
+        if shift % 8 or shift // 8 >= bpp or mode[shift // 8] != 'A': return None
+        mode[shift // 8] = c
+    return ''.join(mode)
+
+# Return fb.bin, it's only loaded once
+_lib = None
+def _load():
+    global _lib
+    if _lib is None: _lib = CDLL(_fb_bin)
+    return _lib
 
 class Framebuffer():
-    # open indexed framebuffer and mmap it
-    def __init__(self, device=None):
+    cache = None    # if a dict, framebuffers are kept open and reused (see fbd.py)
+
+    def __new__(cls, device=None, buffering=None):
+        if cls is Framebuffer and backend == "numpy":
+            try: import fbnumpy
+            except: from . import fbnumpy
+            cls = fbnumpy.Framebuffer
+        if cls.cache is None: return super().__new__(cls)
+        key = (device or "/dev/fb0", buffering or "single")
+        if key not in cls.cache: cls.cache[key] = super().__new__(cls)
+        return cls.cache[key]
+
+    # Open indexed framebuffer and mmap it. If buffering is "double" then
+    # draw into an offscreen page or shadow buffer, which flip() makes visible.
+    def __init__(self, device=None, buffering=None):
+        if hasattr(self, "fbinfo"): return  # already open, from the cache
         if not device: device = "/dev/fb0"
-        self.lib = CDLL(_fb_bin)
-        self.fbinfo = (c_uint*8)();
+        if buffering not in (None, "single", "double"): raise Exception("Invalid buffering '%s'" % buffering)
+        if not os.path.isfile(_fb_bin):
+            raise Exception("Can't find %s\n"
+                "Most likely this is because you didn't build it.\n"
+                "Go to the fbtools directory and run 'make', or set FB_BACKEND=numpy." % _fb_bin)
+        self.lib = _load()
+        self.fbinfo = fbinfo()
         res = self.lib.fbopen(byref(self.fbinfo), bytes(device, 'utf-8'))
         if res:
             raise Exception("fbopen %s failed (%d)" % (device, res))
-        self.height = int(self.fbinfo[0])   # height in pixels
-        self.width = int(self.fbinfo[1])    # width in pixels
-        self.bpp = int(self.fbinfo[2])      # bytes per pixel, can be 2, 3 or 4. If 2 then colorspace is 565.
-        self.red = int(self.fbinfo[3])      # bit offset of red in the pixel
-        self.green = int(self.fbinfo[4])    # bit offset of green in the pixel
-        self.blue = int(self.fbinfo[5])     # bit offset of red in the pixel
+        self._start(device, buffering)
+
+    # private, finish opening once fbinfo describes the framebuffer
+    def _start(self, device, buffering):
+        if buffering == "double" and self.lib.fbdouble(byref(self.fbinfo)):
+            raise Exception("fbdouble %s failed" % device)
+        self.buffering = buffering or "single"
+        self.flipping = self.fbinfo.buffering == 1 # True if double buffering by page flipping
+        self.height = self.fbinfo.height    # height in pixels
+        self.width = self.fbinfo.width      # width in pixels
+        self.bpp = self.fbinfo.bpp          # bytes per pixel, can be 2, 3 or 4. If 2 then colorspace is 565.
+        self.red = self.fbinfo.red          # bit offset of red in the pixel
+        self.green = self.fbinfo.green      # bit offset of green in the pixel
+        self.blue = self.fbinfo.blue        # bit offset of red in the pixel
+        self.stride = self.fbinfo.stride    # bytes per line, may include padding
+        self.rawmode = _rawmode(self.bpp, self.red, self.green, self.blue) # PIL raw mode or None
+        self._memory = {}
+
+    # Writable view of the framebuffer memory being drawn into, 'height' rows
+    # of 'stride' bytes. This changes after flip() if page flipping.
+    @property
+    def memory(self):
+        address = self.fbinfo.mmap
+        if address not in self._memory:
+            self._memory[address] = memoryview((c_ubyte * (self.stride * self.height)).from_address(address)).cast('B', (self.height, self.stride))
+        return self._memory[address]
+
+    # If double buffering, make everything drawn so far visible. If using a
+    # shadow buffer then only rows 'first' to 'last' are copied.
+    def flip(self, first=0, last=None):
+        if self.buffering == "double":
+            if last is None: last = self.height-1
+            if self.lib.fbflip(byref(self.fbinfo), first, last-first+1):
+                raise Exception("fbflip failed")
 
     # write rgb data bytes to framebuffer
     def pack(self, rgb):
@@ -31,10 +125,68 @@ class Framebuffer():
         if self.lib.fbpack(byref(self.fbinfo), pixels, 0, rgb):
             raise Exception("fbpack %d pixels failed" % pixels)
 
-    # get framebuffer to rgb data
+    # get framebuffer to rgb data, returns a bytearray
     def unpack(self):
         pixels = self.width * self.height
-        rgb = create_string_buffer(pixels * 3)
-        if self.lib.fbunpack(byref(self.fbinfo), pixels, 0, rgb):
+        rgb = bytearray(pixels * 3)
+        if self.lib.fbunpack(byref(self.fbinfo), pixels, 0, _pointer(rgb, pixels * 3, writable=True)):
             raise Exception("fbunpack %d pixels failed" % pixels)
-        return bytes(rgb)
+        return rgb
+
+    # Write the w x h rectangle at x, y from rgb data, which can be any object
+    # that supports the buffer protocol. Rows of rgb data are 'stride' bytes
+    # apart, default is w*3.
+    def pack_rect(self, rgb, x, y, w, h, stride=None):
+        stride = stride or w*3
+        if self.lib.fbpack_rect(byref(self.fbinfo), x, y, w, h, stride, _pointer(rgb, stride*(h-1) + w*3)):
+            raise Exception("fbpack_rect %dx%d at %d,%d failed" % (w, h, x, y))
+
+    # Read the w x h rectangle at x, y to rgb data. If rgb is given it must be
+    # a writable object that supports the buffer protocol, with rows 'stride'
+    # bytes apart (default w*3), else a new bytearray is created. Returns rgb.
+    def unpack_rect(self, x, y, w, h, rgb=None, stride=None):
+        stride = stride or w*3
+        if rgb is None: rgb = bytearray(stride*h)
+        if self.lib.fbunpack_rect(byref(self.fbinfo), x, y, w, h, stride, _pointer(rgb, stride*(h-1) + w*3, writable=True)):
+            raise Exception("fbunpack_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        return rgb
+
+    # Write the w x h rectangle at x, y from data that is already in the native
+    # pixel format, i.e. just copy it. Rows of data are 'stride' bytes apart,
+    # default is w*bpp.
+    def write_rect(self, data, x, y, w, h, stride=None):
+        stride = stride or w*self.bpp
+        if self.lib.fbwrite_rect(byref(self.fbinfo), x, y, w, h, stride, _pointer(data, stride*(h-1) + w*self.bpp)):
+            raise Exception("fbwrite_rect %dx%d at %d,%d failed" % (w, h, x, y))
+
+    # Move the w x h rectangle at x, y to x+dx, y+dy, they can overlap
+    def copy_rect(self, x, y, w, h, dx, dy):
+        if self.lib.fbcopy_rect(byref(self.fbinfo), x, y, w, h, dx, dy):
+            raise Exception("fbcopy_rect %dx%d at %d,%d by %d,%d failed" % (w, h, x, y, dx, dy))
+
+    # Fill the w x h rectangle at x, y with the color rgb, a sequence of red,
+    # green and blue values
+    def fill_rect(self, rgb, x, y, w, h):
+        if self.lib.fbfill_rect(byref(self.fbinfo), x, y, w, h, bytes(rgb[:3])):
+            raise Exception("fbfill_rect %dx%d at %d,%d failed" % (w, h, x, y))
+
+    # Blend the w x h rectangle at x, y with the color rgba, a sequence of
+    # red, green, blue and alpha values, e.g. (0, 0, 0, 153) dims it by 60%
+    def blend_rect(self, rgba, x, y, w, h):
+        if self.lib.fbblend_rect(byref(self.fbinfo), x, y, w, h, bytes(rgba[:4])):
+            raise Exception("fbblend_rect %dx%d at %d,%d failed" % (w, h, x, y))
+
+    # Return an array of hashes of each size x size tile of the framebuffer, in
+    # rows of (width+size-1)//size tiles. Compare with a previous array to find
+    # the tiles that changed.
+    def hash_tiles(self, size=32):
+        hashes = array.array('Q', bytes(8 * -(-self.width // size) * -(-self.height // size)))
+        if self.lib.fbhash(byref(self.fbinfo), size, _pointer(hashes, len(hashes) * 8, writable=True)):
+            raise Exception("fbhash %d failed" % size)
+        return hashes
+
+# record hot paths if profiling, see fbprof.py
+if os.environ.get("FB_PROFILE"):
+    try: import fbprof
+    except: from . import fbprof
+    fbprof.instrument(sys.modules[__name__])
@@ -0,0 +1,173 @@
+# fbtools daemon support. The daemon keeps python, PIL, open framebuffers,
+# touch devices and fonts loaded, and runs the fbtools utilities on behalf of
+# clients connected to a unix socket. Each utility calls client() first, which
+# forwards the command line and stdio to the daemon if it's running.
+import os, sys
+
+# Other modules are imported when needed, every utility imports this one
+# first so it's kept light
+
+# Default socket, in a directory only this user can use. Set environment
+# FBD_SOCKET="" to never use the daemon.
+socket_path = os.environ.get("FBD_SOCKET", os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp/fbd-%d" % os.geteuid(), "fbd.sock"))
+
+# Utilities the daemon will run, they must be in the same directory as this module
+tools = ("fbclear", "fbdialog", "fbimage", "fbmenu", "fbtext")
+
+# True in the daemon process, so client() doesn't forward to itself
+serving = False
+
+# private, return True if the process at the other end of unix socket s is
+# run by root or by us, so it can be trusted with our stdio or to run
+# utilities for
+def _trusted(s):
+    import socket, struct
+    pid, uid, gid = struct.unpack("3i", s.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid in (0, os.geteuid())
+
+# If the daemon is running, ask it to run the named utility with our command
+# line, current directory, stdin, stdout and stderr, then exit with its
+# status. Otherwise just return and let the utility run locally.
+def client(tool):
+    if serving or not socket_path: return
+    # anyone could have created the socket, only use it if it's ours or root's
+    try:
+        if os.stat(socket_path).st_uid not in (0, os.geteuid()): return
+    except OSError:
+        return
+    import socket, json
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        s.connect(socket_path)
+        if not _trusted(s): raise OSError("untrusted daemon")
+    except OSError:
+        s.close()
+        return
+    request = json.dumps({"tool": tool, "argv": sys.argv[1:], "cwd": os.getcwd()}).encode()
+    socket.send_fds(s, [request], [0, 1, 2])
+    try:
+        status = s.recv(16)
+    except KeyboardInterrupt:
+        # closing the socket tells the daemon to interrupt the utility
+        status = b"130"
+    sys.exit(int(status or 1))
+
+class Server():
+    def __init__(self, path=None):
+        global serving
+        import socket, threading
+        serving = True
+        self.path = path or socket_path
+        self.here = os.path.dirname(os.path.abspath(__file__))
+        self.code = {}          # compiled utilities
+        self.lock = threading.Lock()
+        self.running = False    # True while a utility can be interrupted
+        self.interrupted = False # True once the watcher has sent SIGINT, until it's handled
+
+        # keep framebuffers and touch devices open
+        try: import fb, touch
+        except: from . import fb, touch
+        fb.Framebuffer.cache = {}
+        touch.Touch.cache = {}
+
+        # the socket's directory must be private, create it if needed
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory): os.mkdir(directory, 0o700)
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(8)
+
+    # Serve clients forever, one at a time
+    def serve(self):
+        import traceback, signal
+        signal.signal(signal.SIGINT, self._sigint)
+        while True:
+            conn, _ = self.sock.accept()
+            try:
+                if _trusted(conn): self.handle(conn)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                conn.close()
+
+    # private, SIGINT handler. The watcher's SIGINT can arrive after the
+    # utility has returned, that's ignored so it doesn't break the cleanup or
+    # stop the daemon. Any other SIGINT raises KeyboardInterrupt as usual.
+    # This runs in the main thread, which may hold self.lock, so don't take it.
+    def _sigint(self, signum, frame):
+        late = self.interrupted and not self.running
+        self.interrupted = False
+        if not late: raise KeyboardInterrupt
+
+    # private, interrupt the utility if the client goes away before it's done
+    def _watch(self, conn, done):
+        import select, signal, threading
+        ready, _, _ = select.select([conn, done], [], [])
+        with self.lock:
+            if self.running and done not in ready:
+                self.interrupted = True
+                # a real signal, so blocking reads in the utility are interrupted too
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+    # Handle one client request
+    def handle(self, conn):
+        import socket, json, threading, traceback
+        msg, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+        try:
+            # must be a request with stdin, stdout and stderr
+            if len(fds) != 3: raise ValueError("expected 3 fds, got %d" % len(fds))
+            request = json.loads(msg)
+            tool, argv, cwd = request["tool"], list(request["argv"]), request["cwd"]
+        except (ValueError, KeyError, TypeError) as e:
+            for fd in fds: os.close(fd)
+            print("Invalid request: %s" % e, file=sys.stderr)
+            return
+        files = [open(fds[0], "r"), open(fds[1], "w"), open(fds[2], "w")]
+
+        saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+        rpipe, wpipe = os.pipe()
+        watcher = threading.Thread(target=self._watch, args=(conn, rpipe), daemon=True)
+        status = 0
+        try:
+            sys.stdin, sys.stdout, sys.stderr = files
+            if tool not in tools: raise Exception("Unsupported utility '%s'" % tool)
+            if tool not in self.code:
+                path = os.path.join(self.here, tool)
+                with open(path) as f: self.code[tool] = compile(f.read(), path, "exec")
+            sys.argv = [tool] + argv
+            os.chdir(cwd)
+            self.running = True
+            watcher.start()
+            try:
+                exec(self.code[tool], {"__name__": "__main__", "__file__": os.path.join(self.here, tool)})
+            finally:
+                # after this the watcher can't interrupt
+                with self.lock: self.running = False
+        except SystemExit as e:
+            if e.code is None: status = 0
+            elif type(e.code) is int: status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except KeyboardInterrupt:
+            status = 130
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            self.running = False
+            os.write(wpipe, b"x")
+            if watcher.is_alive(): watcher.join()
+            os.close(rpipe)
+            os.close(wpipe)
+            sys.argv, sys.stdin, sys.stdout, sys.stderr, cwd = saved
+            os.chdir(cwd)
+            for f in files:
+                try: f.close()
+                except Exception: pass
+        try:
+            conn.send(b"%d" % status)
+        except OSError:
+            pass # client went away
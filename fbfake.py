@@ -0,0 +1,102 @@
+# Fake framebuffer and touch devices, for benchmarking and testing without
+# hardware. The fake framebuffer is ordinary memory, or a file if a path is
+# given, and works with both fb.py backends. The fake touch device is a pipe
+# that events can be written to.
+import os, mmap, time
+from ctypes import *
+
+try: import fb, touch
+except: from . import fb, touch
+
+# Return a fake framebuffer with the given geometry, bpp is bytes per pixel
+# and red, green, blue are bit shifts. Stride defaults to width*bpp. If path
+# is given then the framebuffer memory is that file, else anonymous memory.
+def Framebuffer(width=800, height=480, bpp=4, red=16, green=8, blue=0, stride=None, path=None, buffering=None):
+    if bpp not in (2, 3, 4): raise Exception("Invalid bpp %d" % bpp)
+    if buffering not in (None, "single", "double"): raise Exception("Invalid buffering '%s'" % buffering)
+    stride = stride or width * bpp
+    if stride < width * bpp: raise Exception("Stride %d is too small" % stride)
+    size = stride * height
+    if path:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    else:
+        fd = os.memfd_create("fbfake")
+    try:
+        os.ftruncate(fd, size)
+        memory = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    device = path or "fake"
+
+    if fb.backend == "numpy":
+        try: import fbnumpy
+        except: from . import fbnumpy
+        f = object.__new__(fbnumpy.Framebuffer)
+        f.mmap = memory
+        f.fd = -1
+        f.height, f.width, f.bpp, f.red, f.green, f.blue, f.stride = height, width, bpp, red, green, blue, stride
+        f.yvirtual = height     # no room to page flip, so double buffering uses a shadow buffer
+        f.yoffset = f.visible = 0
+    else:
+        f = object.__new__(fb.Framebuffer)
+        f.lib = fb._load()
+        f.fbinfo = fb.fbinfo(height=height, width=width, bpp=bpp, red=red, green=green, blue=blue, stride=stride,
+                             fd=-1, yvirtual=height, threads=min(os.cpu_count() or 1, 8))
+        f.fbinfo.mmap = f.fbinfo.visible = addressof(c_char.from_buffer(memory))
+        f.mmap = memory # keep it mapped
+    f._start(device, buffering)
+    return f
+
+# Fake touch device, events written with down(), up(), tap() or frame() are
+# returned by touch(), select(), contacts() etc.
+class Touch(touch.Touch):
+    def __init__(self, width=None, height=None, device=None):
+        if hasattr(self, "device"): return
+        self.pipe = os.pipe()
+        self.fd = None
+        self.nslots = 10
+        self.close()
+        self.ids = 0        # last tracking id
+        self.tracking = {}  # slot -> tracking id
+        self.device = "/dev/fd/%d" % self.pipe[0]
+        self.button = touch.BTN_TOUCH
+        self.width = width or 4095
+        self.height = height or 4095
+        self.scale_width = None
+        self.scale_height = None
+
+    # private, write events, each is (type, code, value), followed by EV_SYN
+    def _write(self, *events):
+        now = time.time()
+        sec, usec = int(now), int((now % 1) * 1000000)
+        os.write(self.pipe[1], b''.join(touch.input_event.pack(sec, usec, *e) for e in events + ((0, 0, 0),)))
+
+    # Touch at x, y
+    def down(self, x, y):
+        self._write((1, self.button, 1), (3, 0, x), (3, 1, y))
+
+    # Stop touching
+    def up(self):
+        self._write((1, self.button, 0))
+
+    # Touch and release at x, y
+    def tap(self, x, y):
+        self.down(x, y)
+        self.up()
+
+    # Write a multitouch frame, slots is a dict of {slot: (x, y)} for
+    # contacts that touch or move, or {slot: None} for those that let go
+    def frame(self, slots):
+        events = []
+        for slot, xy in slots.items():
+            events.append((3, touch.ABS_MT_SLOT, slot))
+            if xy is None:
+                self.tracking.pop(slot, None)
+                events.append((3, touch.ABS_MT_TRACKING_ID, -1))
+            else:
+                if slot not in self.tracking:
+                    self.ids += 1
+                    self.tracking[slot] = self.ids
+                    events.append((3, touch.ABS_MT_TRACKING_ID, self.ids))
+                events += [(3, touch.ABS_MT_POSITION_X, xy[0]), (3, touch.ABS_MT_POSITION_Y, xy[1])]
+        self._write(*events)
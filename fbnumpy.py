@@ -0,0 +1,350 @@
+# Framebuffer I/O with numpy instead of fb.bin, for systems that can't build
+# it. Selected by fb.py if fb.bin doesn't exist or environment FB_BACKEND is
+# "numpy". Supports the same methods and attributes as fb.Framebuffer.
+import os, sys, mmap, fcntl, array
+from ctypes import *
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+try: import fb
+except: from . import fb
+
+# See linux/fb.h for more information
+
+class fb_bitfield(Structure):
+    _fields_ = [
+        ("offset", c_uint32),     # beginning of bitfield
+        ("length", c_uint32),     # length of bitfield
+        ("msb_right", c_uint32),  # != 0 : most significant bit is right
+    ]
+
+# Returned by FBIOGET_VSCREENINFO, passed to FBIOPAN_DISPLAY
+class fb_var_screeninfo(Structure):
+    _fields_ = [
+        ("xres", c_uint32),       # visible resolution
+        ("yres", c_uint32),
+        ("xres_virtual", c_uint32), # virtual resolution
+        ("yres_virtual", c_uint32),
+        ("xoffset", c_uint32),    # offset from virtual to visible
+        ("yoffset", c_uint32),
+        ("bits_per_pixel", c_uint32),
+        ("grayscale", c_uint32),
+        ("red", fb_bitfield),
+        ("green", fb_bitfield),
+        ("blue", fb_bitfield),
+        ("transp", fb_bitfield),
+        ("nonstd", c_uint32),
+        ("activate", c_uint32),
+        ("height", c_uint32),
+        ("width", c_uint32),
+        ("accel_flags", c_uint32),
+        ("pixclock", c_uint32),
+        ("left_margin", c_uint32),
+        ("right_margin", c_uint32),
+        ("upper_margin", c_uint32),
+        ("lower_margin", c_uint32),
+        ("hsync_len", c_uint32),
+        ("vsync_len", c_uint32),
+        ("sync", c_uint32),
+        ("vmode", c_uint32),
+        ("rotate", c_uint32),
+        ("colorspace", c_uint32),
+        ("reserved", c_uint32 * 4),
+    ]
+
+# Returned by FBIOGET_FSCREENINFO
+class fb_fix_screeninfo(Structure):
+    _fields_ = [
+        ("id", c_char * 16),
+        ("smem_start", c_ulong),
+        ("smem_len", c_uint32),
+        ("type", c_uint32),
+        ("type_aux", c_uint32),
+        ("visual", c_uint32),
+        ("xpanstep", c_uint16),
+        ("ypanstep", c_uint16),
+        ("ywrapstep", c_uint16),
+        ("line_length", c_uint32), # bytes per line
+        ("mmio_start", c_ulong),
+        ("mmio_len", c_uint32),
+        ("accel", c_uint32),
+        ("capabilities", c_uint16),
+        ("reserved", c_uint16 * 2),
+    ]
+
+FBIOGET_VSCREENINFO = 0x4600
+FBIOGET_FSCREENINFO = 0x4602
+FBIOPAN_DISPLAY = 0x4606
+FBIO_WAITFORVSYNC = 0x40044620
+
+# Return number of rows of w pixels to convert at a time
+def _band(w):
+    return max(1, 32768 // w)
+
+class Framebuffer(fb.Framebuffer):
+    # Open indexed framebuffer and mmap it, same as fbopen() and fbdouble() in fb.c
+    def __init__(self, device=None, buffering=None):
+        if hasattr(self, "fd"): return  # already open, from the cache
+        if not device: device = "/dev/fb0"
+        if buffering not in (None, "single", "double"): raise Exception("Invalid buffering '%s'" % buffering)
+        fd = os.open(device, os.O_RDWR)
+        try:
+            vsi = fb_var_screeninfo()
+            fsi = fb_fix_screeninfo()
+            fcntl.ioctl(fd, FBIOGET_VSCREENINFO, vsi, True)
+            fcntl.ioctl(fd, FBIOGET_FSCREENINFO, fsi, True)
+            lengths = (vsi.red.length, vsi.green.length, vsi.blue.length)
+            if vsi.bits_per_pixel in (24, 32) and lengths == (8, 8, 8): bpp = vsi.bits_per_pixel // 8
+            elif vsi.bits_per_pixel == 16 and lengths == (5, 6, 5): bpp = 2
+            else: raise Exception("Unsupported pixel format")
+            # some drivers don't report line length
+            stride = max(fsi.line_length, vsi.xres_virtual * bpp)
+            self.mmap = mmap.mmap(fd, stride * vsi.yres_virtual, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception as e:
+            os.close(fd)
+            raise Exception("fbopen %s failed (%s)" % (device, e))
+        self.fd = fd
+        self.height = vsi.yres
+        self.width = vsi.xres
+        self.bpp = bpp
+        self.red = vsi.red.offset
+        self.green = vsi.green.offset
+        self.blue = vsi.blue.offset
+        self.stride = stride
+        self.yvirtual = vsi.yres_virtual
+        self.yoffset = vsi.yoffset
+        # draw into whatever is visible, offsets are bytes into the mmap
+        self.visible = (vsi.yoffset * stride) + (vsi.xoffset * bpp)
+        self._start(device, buffering)
+
+    # private, finish opening once the mmap and geometry attributes are set
+    def _start(self, device, buffering):
+        self.rawmode = fb._rawmode(self.bpp, self.red, self.green, self.blue)
+        self.draw = self.visible
+        self.shadow = None
+        self.flipping = False
+        self._memory = {}
+        self._weights = {}  # for hash_tiles()
+        self.buffering = buffering or "single"
+        if self.buffering == "double":
+            if self.yvirtual >= self.height * 2 and not self.yoffset % self.height:
+                # draw into the next page, wrapping to the first
+                yoffset = self.yoffset + self.height
+                if yoffset + self.height > self.yvirtual: yoffset = 0
+                self.draw = yoffset * self.stride
+                self.flipping = True
+            else:
+                self.shadow = bytearray(self.height * self.stride)
+            np.asarray(self.memory)[:] = self._page(self.visible)
+
+    # private, writable view of the 'height' rows of 'stride' bytes at offset
+    # into the mmap
+    def _page(self, offset):
+        return memoryview(self.mmap)[offset:offset + (self.height * self.stride)].cast('B', (self.height, self.stride))
+
+    # Writable view of the framebuffer memory being drawn into, 'height' rows
+    # of 'stride' bytes. This changes after flip() if page flipping.
+    @property
+    def memory(self):
+        if self.shadow is not None: key = -1
+        else: key = self.draw
+        if key not in self._memory:
+            if self.shadow is not None: self._memory[key] = memoryview(self.shadow).cast('B', (self.height, self.stride))
+            else: self._memory[key] = self._page(self.draw)
+        return self._memory[key]
+
+    # If double buffering, make everything drawn so far visible. If using a
+    # shadow buffer then only rows 'first' to 'last' are copied.
+    def flip(self, first=0, last=None):
+        if self.buffering != "double": return
+        if last is None: last = self.height-1
+        if self.flipping:
+            vsi = fb_var_screeninfo()
+            try:
+                fcntl.ioctl(self.fd, FBIOGET_VSCREENINFO, vsi, True)
+                vsi.yoffset = self.draw // self.stride
+                fcntl.ioctl(self.fd, FBIOPAN_DISPLAY, vsi, True)
+            except OSError:
+                raise Exception("fbflip failed")
+            self._vsync()
+            self.visible, self.draw = self.draw, self.visible
+            self.yoffset = vsi.yoffset
+        elif first < self.height:
+            last = min(last, self.height-1)
+            self._vsync()
+            np.asarray(self._page(self.visible))[first:last+1] = np.asarray(self.memory)[first:last+1]
+
+    # private, wait for vsync, not all drivers support this (and fake
+    # framebuffers have no fd)
+    def _vsync(self):
+        if self.fd < 0: return
+        try: fcntl.ioctl(self.fd, FBIO_WAITFORVSYNC, c_uint32(0))
+        except OSError: pass
+
+    # private, return the w x h rectangle of draw buffer pixels at x, y as a
+    # writable h x w x bpp array of bytes, or h x w array of pixel values if
+    # 'word' is True. Return None if out of range.
+    def _rect(self, x, y, w, h, word=False):
+        if x < 0 or y < 0 or x+w > self.width or y+h > self.height: return None
+        offset = (y * self.stride) + (x * self.bpp)
+        if word: return np.ndarray((h, w), "=u%d" % self.bpp, self.memory.cast('B'), offset, (self.stride, self.bpp))
+        return np.ndarray((h, w, self.bpp), np.uint8, self.memory.cast('B'), offset, (self.stride, self.bpp, 1))
+
+    # private, return rgb data in an object that supports the buffer protocol
+    # as an h x w x 3 array, rows are 'stride' bytes apart
+    def _rgb(self, rgb, w, h, stride, writable=False):
+        size = stride*(h-1) + w*3
+        m = memoryview(rgb).cast('B')
+        if m.nbytes < size: raise Exception("Buffer has %d bytes, need %d" % (m.nbytes, size))
+        if writable and m.readonly: raise Exception("Buffer is read-only")
+        return as_strided(np.frombuffer(m, np.uint8, size), (h, w, 3), (stride, 3, 1), writeable=writable)
+
+    # private, pack h x w x 3 rgb array to the rectangle at x, y
+    def _pack(self, src, x, y):
+        h, w = src.shape[:2]
+        if self.rawmode:
+            # channels are whole bytes, just shuffle them
+            dst = self._rect(x, y, w, h)
+            for i, c in enumerate(self.rawmode):
+                if c == 'A': dst[..., i] = 0xff
+                else: dst[..., i] = src[..., "RGB".index(c)]
+            return
+        if self.bpp == 2:
+            r, g, b = ((src[..., i] >> n).astype(np.uint16) for i, n in ((0, 3), (1, 2), (2, 3)))
+            self._rect(x, y, w, h, True)[:] = (r << self.red) | (g << self.green) | (b << self.blue)
+            return
+        r, g, b = (src[..., i].astype(np.uint32) for i in range(3))
+        if self.bpp == 4:
+            # set the unused byte, whichever it is
+            n = ~((0xff << self.red) | (0xff << self.green) | (0xff << self.blue)) & 0xffffffff
+            self._rect(x, y, w, h, True)[:] = (r << self.red) | (g << self.green) | (b << self.blue) | n
+        else:
+            n = (r << self.red) | (g << self.green) | (b << self.blue)
+            dst = self._rect(x, y, w, h)
+            for i in range(3): dst[..., i] = n >> (i*8) # little-endian
+
+    # private, unpack the rectangle at x, y to h x w x 3 rgb array
+    def _unpack(self, x, y, dst):
+        h, w = dst.shape[:2]
+        if self.rawmode:
+            src = self._rect(x, y, w, h)
+            for i, c in enumerate("RGB"): dst[..., i] = src[..., self.rawmode.index(c)]
+            return
+        if self.bpp == 2:
+            n = self._rect(x, y, w, h, True)
+            dst[..., 0] = (n >> self.red) << 3
+            dst[..., 1] = (n >> self.green) << 2
+            dst[..., 2] = (n >> self.blue) << 3
+            return
+        if self.bpp == 4:
+            n = self._rect(x, y, w, h, True)
+        else:
+            n = self._rect(x, y, w, h).astype(np.uint32)
+            n = n[..., 0] | (n[..., 1] << 8) | (n[..., 2] << 16) # little-endian
+        dst[..., 0] = n >> self.red
+        dst[..., 1] = n >> self.green
+        dst[..., 2] = n >> self.blue
+
+    # write rgb data bytes to framebuffer
+    def pack(self, rgb):
+        pixels = len(rgb) // 3
+        if pixels > self.width * self.height: raise Exception("fbpack %d pixels failed" % pixels)
+        rows, extra = divmod(pixels, self.width)
+        if rows: self.pack_rect(rgb, 0, 0, self.width, rows)
+        if extra: self.pack_rect(memoryview(rgb).cast('B')[rows*self.width*3:], 0, rows, extra, 1)
+
+    # get framebuffer to rgb data, returns a bytearray
+    def unpack(self):
+        return self.unpack_rect(0, 0, self.width, self.height)
+
+    # Write the w x h rectangle at x, y from rgb data, which can be any object
+    # that supports the buffer protocol. Rows of rgb data are 'stride' bytes
+    # apart, default is w*3.
+    def pack_rect(self, rgb, x, y, w, h, stride=None):
+        stride = stride or w*3
+        if self._rect(x, y, w, h) is None: raise Exception("fbpack_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        if w and h:
+            src = self._rgb(rgb, w, h, stride)
+            # in bands, so temporary arrays stay in cache
+            n = _band(w)
+            for row in range(0, h, n): self._pack(src[row:row+n], x, y+row)
+
+    # Read the w x h rectangle at x, y to rgb data. If rgb is given it must be
+    # a writable object that supports the buffer protocol, with rows 'stride'
+    # bytes apart (default w*3), else a new bytearray is created. Returns rgb.
+    def unpack_rect(self, x, y, w, h, rgb=None, stride=None):
+        stride = stride or w*3
+        if rgb is None: rgb = bytearray(stride*h)
+        if self._rect(x, y, w, h) is None: raise Exception("fbunpack_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        if w and h:
+            dst = self._rgb(rgb, w, h, stride, writable=True)
+            n = _band(w)
+            for row in range(0, h, n): self._unpack(x, y+row, dst[row:row+n])
+        return rgb
+
+    # Write the w x h rectangle at x, y from data that is already in the native
+    # pixel format, i.e. just copy it. Rows of data are 'stride' bytes apart,
+    # default is w*bpp.
+    def write_rect(self, data, x, y, w, h, stride=None):
+        stride = stride or w*self.bpp
+        dst = self._rect(x, y, w, h)
+        if dst is None: raise Exception("fbwrite_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        if w and h:
+            size = stride*(h-1) + w*self.bpp
+            m = memoryview(data).cast('B')
+            if m.nbytes < size: raise Exception("Buffer has %d bytes, need %d" % (m.nbytes, size))
+            dst[...] = as_strided(np.frombuffer(m, np.uint8, size), (h, w, self.bpp), (stride, self.bpp, 1))
+
+    # Move the w x h rectangle at x, y to x+dx, y+dy, they can overlap
+    def copy_rect(self, x, y, w, h, dx, dy):
+        src = self._rect(x, y, w, h)
+        dst = self._rect(x+dx, y+dy, w, h)
+        if src is None or dst is None: raise Exception("fbcopy_rect %dx%d at %d,%d by %d,%d failed" % (w, h, x, y, dx, dy))
+        dst[...] = src # numpy copies via a temporary if they overlap
+
+    # Fill the w x h rectangle at x, y with the color rgb, a sequence of red,
+    # green and blue values
+    def fill_rect(self, rgb, x, y, w, h):
+        dst = self._rect(x, y, w, h)
+        if dst is None: raise Exception("fbfill_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        if w and h:
+            # pack one pixel, then copy it across the rows
+            self._pack(np.array(rgb[:3], np.uint8).reshape(1, 1, 3), x, y)
+            dst.reshape(h, w * self.bpp)[...] = np.tile(dst[0, 0], w)
+
+    # Blend the w x h rectangle at x, y with the color rgba, a sequence of
+    # red, green, blue and alpha values, e.g. (0, 0, 0, 153) dims it by 60%
+    def blend_rect(self, rgba, x, y, w, h):
+        if self._rect(x, y, w, h) is None: raise Exception("fbblend_rect %dx%d at %d,%d failed" % (w, h, x, y))
+        a = rgba[3]
+        c = np.array(rgba[:3], np.uint16) * a + 127
+        n = _band(w)
+        for row in range(0, h, n):
+            rgb = np.empty((min(n, h-row), w, 3), np.uint8)
+            self._unpack(x, y+row, rgb)
+            self._pack(((rgb * np.uint16(255 - a) + c) // 255).astype(np.uint8), x, y+row)
+
+    # Return an array of hashes of each size x size tile of the framebuffer, in
+    # rows of (width+size-1)//size tiles, size must be a multiple of 8. Each
+    # hash is a weighted sum of the tile's 64-bit words, with odd weights so
+    # that changing any one word changes the hash.
+    def hash_tiles(self, size=32):
+        if size <= 0 or size % 8: raise Exception("fbhash %d failed" % size)
+        columns, rows = -(-self.width // size), -(-self.height // size)
+        n = size * self.bpp
+        pixels = np.asarray(self.memory)[:, :self.width * self.bpp]
+        if pixels.shape != (rows * size, columns * n):
+            padded = np.zeros((rows * size, columns * n), np.uint8)
+            padded[:self.height, :self.width * self.bpp] = pixels
+            pixels = padded
+        words = np.ascontiguousarray(pixels).view(np.uint64).reshape(rows, size, columns, n // 8)
+        if (size, n) not in self._weights:
+            self._weights[(size, n)] = np.random.default_rng(size).integers(0, 1 << 63, (size, 1, n // 8), np.uint64) * 2 + 1
+        hashes = (words * self._weights[(size, n)]).sum(axis=(1, 3), dtype=np.uint64)
+        return array.array('Q', hashes.tobytes())
+
+# record hot paths if profiling, see fbprof.py
+if os.environ.get("FB_PROFILE"):
+    try: import fbprof
+    except: from . import fbprof
+    fbprof.instrument(sys.modules[__name__])
@@ -0,0 +1,202 @@
+# Optional profiling of fbtools hot paths. Nothing is measured unless enabled,
+# by setting environment FB_PROFILE to a file name (or "-" for stderr) before
+# the modules are imported, or with Screen(profile=...). Then methods of
+# fb.py, fbnumpy.py, screen.py and touch.py are wrapped to record how long
+# each call takes, and for the framebuffer how many bytes it moves, and the
+# results are written to the file as JSON on exit or when the process gets
+# SIGUSR1. When not enabled the methods aren't touched, so cost nothing.
+#
+# Operations recorded are:
+#
+#   fb.<method>             - framebuffer pack, unpack, pack_rect etc
+#   layer.text, layer.image - queue or render text and images
+#   layer.merge             - raise a layer and damage what changed
+#   screen.display          - display() as a whole, then split into:
+#   screen.display.convert  -   resolving renders and compositing layers
+#   screen.display.pack     -   writing to the framebuffer
+#   touch.latency           - kernel time of a touch or release event until
+#                             Touch.touch() returns it
+#
+# Each has a count, total, min and max time in ms, total bytes for the
+# framebuffer, and a histogram of {us: count} where 'us' is the power of 2
+# microseconds that the time is less than.
+import os, sys, time, math, json, threading, functools
+
+enabled = False     # True once enable() is called
+output = None       # where dump() writes by default, a file name or "-"
+stats = {}          # operation name -> Stat
+
+class Stat():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.bytes = 0
+        self.buckets = {}
+
+    # Record a call that took 'seconds' and moved 'nbytes'
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min: self.min = seconds
+        if seconds > self.max: self.max = seconds
+        self.bytes += nbytes
+        us = 1 << max(0, math.frexp(seconds * 1000000)[1])
+        self.buckets[us] = self.buckets.get(us, 0) + 1
+
+    def report(self):
+        r = {"count": self.count, "ms": self.total * 1000, "min": (self.min or 0) * 1000, "max": self.max * 1000,
+             "histogram": {str(us): self.buckets[us] for us in sorted(self.buckets)}}
+        if self.bytes: r["bytes"] = self.bytes
+        return r
+
+# Record an operation that took 'seconds' and moved 'nbytes'
+def record(name, seconds, nbytes=0):
+    if name not in stats: stats[name] = Stat()
+    stats[name].add(seconds, nbytes)
+
+# Return the results as a dict of {name: report}
+def report():
+    return {name: stats[name].report() for name in sorted(stats)}
+
+# Write the results as JSON to a file name, or "-" for stderr, default is
+# 'output'. The file is replaced each time.
+def dump(path=None):
+    path = path or output
+    if not path: return
+    text = json.dumps(report(), indent=1) + "\n"
+    if path == "-":
+        sys.stderr.write(text)
+        sys.stderr.flush()
+    else:
+        with open(path + ".tmp", "w") as f: f.write(text)
+        os.replace(path + ".tmp", path)
+
+# Forget results so far
+def reset():
+    stats.clear()
+
+# private, per-thread time spent in framebuffer methods, see _display()
+_fb = threading.local()
+
+# private, wrap framebuffer method 'func', nbytes(self, *args) returns the
+# bytes it moves. Only the outermost call counts towards _fb.time, e.g.
+# fbnumpy's pack() calls pack_rect(). The bytes are counted first, and as 0
+# if the arguments are bad, so the method raises its own exception.
+def _framebuffer(name, func, nbytes):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try: n = nbytes(self, *args, **kwargs)
+        except Exception: n = 0
+        depth = getattr(_fb, "depth", 0)
+        _fb.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _fb.depth = depth
+            if not depth: _fb.time = getattr(_fb, "time", 0.0) + elapsed
+            record(name, elapsed, n)
+    return wrapper
+
+# private, wrap method 'func' to record how long it takes
+def _timed(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+# private, wrap Screen.display(), the time not spent in framebuffer methods
+# is converting
+def _display(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        before = getattr(_fb, "time", 0.0)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            packing = getattr(_fb, "time", 0.0) - before
+            record(name, elapsed)
+            record(name + ".convert", elapsed - packing)
+            record(name + ".pack", packing)
+    return wrapper
+
+# private, wrap Touch.touch() to record the time since the kernel stamped the
+# event it returns. Event times are from the realtime clock.
+def _latency(name, func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        report = func(self, *args, **kwargs)
+        if report is not False and self.time: record(name, max(0.0, time.time() - self.time))
+        return report
+    return wrapper
+
+# private, return a function that wraps framebuffer methods, nbytes(self,
+# *args) returns the bytes a call moves
+def _bytes(nbytes):
+    return lambda name, func: _framebuffer(name, func, nbytes)
+
+# private, module name -> list of (class, method, operation name, wrap), where
+# wrap(name, func) returns the wrapped method
+_targets = {
+    "fb": [
+        ("Framebuffer", "pack", "fb.pack", _bytes(lambda self, rgb: len(memoryview(rgb).cast('B')))),
+        ("Framebuffer", "unpack", "fb.unpack", _bytes(lambda self: self.width * self.height * 3)),
+        ("Framebuffer", "pack_rect", "fb.pack_rect", _bytes(lambda self, rgb, x, y, w, h, stride=None: w * h * 3)),
+        ("Framebuffer", "unpack_rect", "fb.unpack_rect", _bytes(lambda self, x, y, w, h, rgb=None, stride=None: w * h * 3)),
+        ("Framebuffer", "write_rect", "fb.write_rect", _bytes(lambda self, data, x, y, w, h, stride=None: w * h * self.bpp)),
+        ("Framebuffer", "copy_rect", "fb.copy_rect", _bytes(lambda self, x, y, w, h, dx, dy: w * h * self.bpp)),
+        ("Framebuffer", "fill_rect", "fb.fill_rect", _bytes(lambda self, rgb, x, y, w, h: w * h * self.bpp)),
+        ("Framebuffer", "blend_rect", "fb.blend_rect", _bytes(lambda self, rgba, x, y, w, h: w * h * self.bpp)),
+        ("Framebuffer", "flip", "fb.flip", _bytes(lambda self, first=0, last=None:
+            ((self.height-1 if last is None else last) - first + 1) * self.stride if self.buffering == "double" else 0)),
+    ],
+    "screen": [
+        ("Layer", "text", "layer.text", _timed),
+        ("Layer", "image", "layer.image", _timed),
+        ("Layer", "merge", "layer.merge", _timed),
+        ("Screen", "display", "screen.display", _display),
+    ],
+    "touch": [("Touch", "touch", "touch.latency", _latency)],
+}
+_targets["fbnumpy"] = _targets["fb"]
+
+# Wrap the recorded methods of the given module (fb, fbnumpy, screen or
+# touch). Only methods the class defines itself are wrapped, so inherited
+# ones aren't recorded twice. Does nothing if already done.
+def instrument(module):
+    for cls, method, name, wrap in _targets.get(module.__name__.rpartition(".")[2], ()):
+        cls = getattr(module, cls)
+        func = cls.__dict__.get(method)
+        if func is None or getattr(func, "profiled", False): continue
+        wrapper = wrap(name, func)
+        wrapper.profiled = True
+        setattr(cls, method, wrapper)
+
+# Start profiling, writing results to 'path' (a file name or "-" for stderr)
+# on exit or SIGUSR1, or only when dump() is called if None. The modules
+# already imported are instrumented, the others do it themselves when
+# imported if FB_PROFILE is set.
+def enable(path=None):
+    global enabled, output
+    if path: output = path
+    if not enabled:
+        enabled = True
+        import atexit, signal
+        atexit.register(dump)
+        try: signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+        except ValueError: pass # not the main thread
+    package = __name__.rpartition(".")[0]
+    for name in _targets:
+        module = sys.modules.get(package + "." + name if package else name)
+        if module: instrument(module)
+
+if os.environ.get("FB_PROFILE"): enable(os.environ["FB_PROFILE"])
@@ -0,0 +1,56 @@
+# Framebuffer recording format, written by fbcap and read by fbplay. A
+# recording, or the stream sent to viewers of fbcap's mirror socket, is a
+# header followed by frames:
+#
+#   header: "FBREC1\n", then width and height as little-endian uint16
+#   frame:  time in seconds as a little-endian double, number of rectangles
+#           as uint32, then for each rectangle x, y, width and height as
+#           uint16, length as uint32, then 'length' bytes of zlib compressed
+#           RGB data
+#
+# The first frame after a header covers the entire screen, the rest only
+# what changed. Recordings are appended to by adding another header.
+import struct, zlib
+
+magic = b"FBREC1\n"
+_header = struct.Struct("<HH")
+_frame = struct.Struct("<dI")
+_rect = struct.Struct("<HHHHI")
+
+# Return a header for a screen of the given size
+def header(width, height):
+    return magic + _header.pack(width, height)
+
+# Return a frame with the given time and list of rectangles, each is (x, y,
+# w, h, rgb)
+def frame(time, rects):
+    out = [_frame.pack(time, len(rects))]
+    for x, y, w, h, rgb in rects:
+        data = zlib.compress(rgb, 1)
+        out += [_rect.pack(x, y, w, h, len(data)), data]
+    return b"".join(out)
+
+# private, read exactly n bytes from file object f, or raise EOFError
+def _read(f, n):
+    data = f.read(n)
+    if len(data) < n: raise EOFError
+    return data
+
+# Generate ("header", width, height) or ("frame", time, rects) for each header
+# or frame read from file object f, rects is a list of (x, y, w, h, rgb).
+# Stops at the end of the file.
+def read(f):
+    try:
+        while True:
+            data = _read(f, len(magic))
+            if data == magic:
+                yield ("header",) + _header.unpack(_read(f, _header.size))
+                continue
+            time, count = _frame.unpack(data + _read(f, _frame.size - len(data)))
+            rects = []
+            for n in range(count):
+                x, y, w, h, length = _rect.unpack(_read(f, _rect.size))
+                rects.append((x, y, w, h, zlib.decompress(_read(f, length))))
+            yield ("frame", time, rects)
+    except EOFError:
+        return
@@ -1,12 +1,31 @@
 # Frame buffer graphics manipulation using PIL
-import os, sys, re, PIL.Image as Image, PIL.ImageFont as Font, PIL.ImageDraw as Draw
+import os, sys, re, functools, collections, threading, importlib
 
 try: import fb              # if fbtools is in the path
 except: from . import fb    # if fbtools is a package
 
+# A module that's imported when first used, so utilities that don't need it
+# (e.g. fbclear doesn't need PIL to fill the screen) start faster
+class _Lazy():
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+Image = _Lazy("PIL.Image")
+Font = _Lazy("PIL.ImageFont")
+Draw = _Lazy("PIL.ImageDraw")
+
 # directory containing this module contains needed fonts
 _here = os.path.dirname(__file__) or '.'
 
+# Color strings like 'blue53' and '#RGB'
+_alpha_color = re.compile(r'^[a-z]+\d{2}$')
+_hex_color = re.compile(r'^#[0-9a-f]+$')
+
 class Color():
     _colors = {
         # https://en.wikipedia.org/wiki/Web_colors
@@ -29,46 +48,55 @@ class Color():
         "purple"    : (128, 0, 128)
     }
 
-    def __new__(this, color, **kwargs):
+    _interned = {}  # (color, alpha) -> Color
+
+    __slots__ = ("red", "green", "blue", "alpha", "rgb", "rgba", "rgbx")
+
+    # Colors are immutable and interned, so each distinct color string is only
+    # parsed once
+    def __new__(this, color=None, alpha=255):
         if type(color) is Color: return color   # already a Color, just return it
-        return super().__new__(this)            # otherwise return new object
+        self = this._interned.get((color, alpha))
+        if self is None:
+            self = super().__new__(this)
+            self._parse(color, alpha)
+            if len(this._interned) >= 1024: this._interned.clear() # someone's making up colors
+            this._interned[(color, alpha)] = self
+        return self
 
-    def __init__(self, color, alpha=255):
-        if type(color) is Color: return         # already a Color, do nothing
+    def __setattr__(self, name, value):
+        raise AttributeError("Color is immutable")
+
+    # private, set attributes from the color string
+    def _parse(self, color, alpha):
         color = (color or "black").lower()
         if color == "transparent": color = "black00"
-        if re.match('^[a-z]+\d{2}$', color):
+        if _alpha_color.match(color):
             # eg blue53 is blue with 53% alph
             alpha = int(255 * (int(color[-2:]) / 100))
             color = color[:-2]
         if color in self._colors:
-            self.red, self.green, self.blue = self._colors[color]
-            self.alpha = alpha
-        elif len(color) in [4,5,7,9] and re.match('^#[0-9a-f]+$', color):
+            red, green, blue = self._colors[color]
+        elif len(color) in [4,5,7,9] and _hex_color.match(color):
             if len(color) <= 5:
                 # #RGB or #RGBA
-                self.red = int(color[1],16) * 17
-                self.green = int(color[2],16) * 17
-                self.blue = int(color[3],16) * 17
-                self.alpha = alpha if len(color) == 4 else int(color[4],16) * 17
+                red = int(color[1],16) * 17
+                green = int(color[2],16) * 17
+                blue = int(color[3],16) * 17
+                alpha = alpha if len(color) == 4 else int(color[4],16) * 17
             else:
                 # #RRGGBB or #RRGGBBAA
-                self.red = int(color[1:3], 16)
-                self.green = int(color[3:5], 16)
-                self.blue = int(color[5:7], 16)
-                self.alpha = alpha if len(color) == 7 else int(color[7:9],16)
+                red = int(color[1:3], 16)
+                green = int(color[3:5], 16)
+                blue = int(color[5:7], 16)
+                alpha = alpha if len(color) == 7 else int(color[7:9],16)
         else:
             raise Exception("Invalid color '%s'" % color)
+        for name, value in (("red", red), ("green", green), ("blue", blue), ("alpha", alpha),
+                            # tuples for use with PIL
+                            ("rgb", (red, green, blue)), ("rgba", (red, green, blue, alpha)), ("rgbx", (red, green, blue, 255))):
+            object.__setattr__(self, name, value)
 
-    # return various tuples for use with PIL
-    @property
-    def rgb(self): return (self.red, self.green, self.blue)
-
-    @property
-    def rgba(self): return (self.red, self.green, self.blue, self.alpha)
-
-    @property
-    def rgbx(self): return (self.red, self.green, self.blue, 255)
 
 class Align():
     _west = 1
@@ -94,28 +122,57 @@ class Align():
                "se":          _south|_east,
                "southeast":   _south|_east }
 
-    def __init__(self, align):
-        if align is None:
-            a = 0 # center
-        else:
-            try:
-                a = int(align)
-            except:
-                a = self._align.get(align.lower(),None)
-            if a not in self._align.values(): raise Exception("Invalid alignment '%s'" % str(align))
+    _interned = {}  # align -> Align
 
-        self.west   = bool(a & self._west)
-        self.north  = bool(a & self._north)
-        self.east   = bool(a & self._east)
-        self.south  = bool(a & self._south)
+    __slots__ = ("west", "north", "east", "south")
+
+    # Aligns are immutable and interned
+    def __new__(this, align=None):
+        if type(align) is Align: return align   # already an Align, just return it
+        self = this._interned.get(align)
+        if self is None:
+            if align is None:
+                a = 0 # center
+            else:
+                try:
+                    a = int(align)
+                except:
+                    a = this._align.get(align.lower(),None)
+                if a not in this._align.values(): raise Exception("Invalid alignment '%s'" % str(align))
+            self = super().__new__(this)
+            object.__setattr__(self, "west", bool(a & this._west))
+            object.__setattr__(self, "north", bool(a & this._north))
+            object.__setattr__(self, "east", bool(a & this._east))
+            object.__setattr__(self, "south", bool(a & this._south))
+            this._interned[align] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Align is immutable")
 
 class Style():
-    def __new__(this, style):
+    _interned = {}  # style -> Style
+
+    __slots__ = ("point", "columns", "min", "max", "entire", "slash", "align")
+
+    # Styles are immutable and interned, so each distinct style string is only
+    # parsed once
+    def __new__(this, style=None):
         if type(style) is Style: return style   # already a Style, just return it
-        return super().__new__(this)            # otherwise return new object
+        self = this._interned.get(style)
+        if self is None:
+            self = super().__new__(this)
+            self._parse(style)
+            if len(this._interned) >= 1024: this._interned.clear()
+            this._interned[style] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Style is immutable")
 
-    def __init__(self, style):
-        if type(style) is Style: return         # already a Style, do nothing
+    # private, set attributes from the style string
+    def _parse(self, style):
+        set = lambda name, value: object.__setattr__(self, name, value)
         # Parse font style string, containing:
         #   =NN    -> set specific point size (default 0, no point)
         #   [+]NN  -> wrap text to NN columns, scale to longest line (default 0, don't actually wrap)
@@ -134,26 +191,186 @@ class Style():
                     if key: got[key]=value
                     key = None
                     if c in "!/": got[c] = True
-                    elif c is not " ": key = c
+                    elif c != " ": key = c
                     value=""
                 elif key: value += c
                 else: raise Exception("Unexpected character '%s' in style" % c)
             if key: got[key]=value
 
-        self.point = self.columns = self.min = self.max = self.all = self.slash = None
+        point = columns = min = max = entire = slash = None
         if '=' in got:
-            self.point = int(got['='])
-            assert self.point > 0
+            point = int(got['='])
+            assert point > 0
         else:
-            self.columns = int(got.get('+',0) or '0')
-            assert self.columns >= 0
-            self.min = int(got.get('>',0))
-            assert self.min >= 0
-            self.max = int(got.get('<',0))
-            assert self.min >= 0
-            self.entire = '!' in got
-            self.slash = '/' in got
-        self.align = Align(got.get('@','center'))
+            columns = int(got.get('+',0) or '0')
+            assert columns >= 0
+            min = int(got.get('>',0))
+            assert min >= 0
+            max = int(got.get('<',0))
+            assert max >= 0
+            entire = '!' in got
+            slash = '/' in got
+        set("point", point)
+        set("columns", columns)
+        set("min", min)
+        set("max", max)
+        set("entire", entire)
+        set("slash", slash)
+        set("align", Align(got.get('@','center')))
+
+# Return a font of given path and point size, cached. A FreeType font can't
+# be used by two threads at once, so each thread has its own.
+_fonts = threading.local()
+def _font(path, size):
+    fonts = getattr(_fonts, "fonts", None)
+    if fonts is None: fonts = _fonts.fonts = {}
+    font = fonts.get((path, size))
+    if font is None:
+        if len(fonts) >= 32: fonts.clear()
+        font = fonts[(path, size)] = Font.truetype(font=path, size=size)
+    return font
+
+# Return (width, height) points-per-pixel for font path, cached. This fails
+# miserably if the font is not monospaced.
+@functools.lru_cache(maxsize=32)
+def _scale(path):
+    f = Font.truetype(font=path, size=2048)
+    return 2048/f.getsize(" ")[0], 2048/f.font.height # meh
+
+# Return (width, height) of a character cell for font path and point size,
+# cached. Width is meaningless for proportional fonts.
+@functools.lru_cache(maxsize=32)
+def _cell(path, size):
+    f = _font(path, size)
+    return f.getsize(" ")[0], f.font.height
+
+# Return an "L" image of a line of text rendered in font path and point size,
+# cached. The color is applied when the image is used as a paste mask, so
+# it isn't part of the key.
+@functools.lru_cache(maxsize=256)
+def _line(text, path, size):
+    f = _font(path, size)
+    mask = Image.new("L", f.getsize(text))
+    Draw.Draw(mask).text((0, 0), text, font=f, fill=255)
+    return mask
+
+# Return the size to scale an image of given size to, to fit in width x height.
+# The aspect ratio is kept unless stretch is True.
+def _fitted(size, width, height, stretch):
+    if stretch or size == (width, height): return width, height
+    aspect = min(width/size[0], height/size[1])
+    return int(size[0] * aspect) or 1, int(size[1] * aspect) or 1
+
+# Return an opened image as RGBA, scaled as per _fitted(). If the image is a
+# JPEG much larger than that, it's decoded at reduced resolution.
+def _decode(img, width, height, stretch):
+    size = _fitted(img.size, width, height, stretch)
+    if size[0] < img.width and size[1] < img.height: img.draft(None, size)
+    if img.mode != "RGBA": img = img.convert("RGBA")
+    if img.size != size: img = img.resize(size)
+    return img
+
+# Cache of decoded and scaled image files, for Layer.image(). Images are kept
+# in memory up to 'size' bytes, least recently used are discarded first. If
+# 'path' is a directory then scaled images are also kept there, so they
+# don't have to be decoded again after a restart.
+class ImageCache():
+    def __init__(self, size=64 << 20, path=None):
+        self.size = size
+        self.path = path
+        self.used = 0                               # bytes in memory
+        self.images = collections.OrderedDict()     # key -> RGBA image
+        self.lock = threading.Lock()                # images are loaded by Screen's threads
+
+    # Return the named image file as an RGBA image scaled as per _fitted()
+    def load(self, filename, width, height, stretch):
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size, width, height, bool(stretch))
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+                return img
+        if self.path:
+            # maybe it's on disk
+            import hashlib
+            name = os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest())
+            try:
+                with open(name, "rb") as f:
+                    w, h = (int(n) for n in f.readline().split())
+                    img = Image.frombytes("RGBA", (w, h), f.read())
+            except (OSError, ValueError):
+                pass
+        if img is None:
+            img = _decode(Image.open(filename), width, height, stretch)
+            if self.path:
+                try:
+                    os.makedirs(self.path, exist_ok=True)
+                    tmp = "%s.%d.tmp" % (name, threading.get_ident())
+                    with open(tmp, "wb") as f:
+                        f.write(b"%d %d\n" % img.size)
+                        f.write(img.tobytes())
+                    os.replace(tmp, name)
+                except OSError:
+                    pass # oh well
+        size = img.width * img.height * 4
+        with self.lock:
+            if size <= self.size and key not in self.images:
+                self.images[key] = img
+                self.used += size
+                while self.used > self.size:
+                    _, old = self.images.popitem(last=False)
+                    self.used -= old.width * old.height * 4
+        return img
+
+    # Discard all images in memory
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.used = 0
+
+# The image cache used by Layer.image(), environment FB_IMAGE_CACHE can name
+# a directory to keep scaled images in
+images = ImageCache(path=os.environ.get("FB_IMAGE_CACHE") or None)
+
+# Return an "L" image of a character in font path and point size, cropped or
+# extended to a character cell, cached
+@functools.lru_cache(maxsize=1024)
+def _glyph(char, path, size):
+    return _line(char, path, size).crop((0, 0) + _cell(path, size))
+
+# PIL raw modes that an RGBA image can be packed to directly
+_packable = ("RGBA", "BGRA", "ABGR", "RGB", "BGR")
+
+# Return the box (left, top, right, bottom) of the framebuffer as an opaque
+# RGBA image
+def _readback(fb, left, top, right, bottom):
+    width, height = right-left+1, bottom-top+1
+    if fb.bpp == 4 and fb.rawmode:
+        # copy just the box's part of each row from framebuffer memory and
+        # decode that, then force the unused byte opaque
+        memory, n = fb.memory.cast('B'), width * 4
+        rows = b"".join(memory[o:o+n] for o in range(top * fb.stride + left * 4, (bottom+1) * fb.stride, fb.stride))
+        i = Image.frombytes("RGBA", (width, height), rows, "raw", fb.rawmode)
+        i.putalpha(255)
+        return i
+    return Image.frombuffer("RGB", (width, height), fb.unpack_rect(left, top, width, height), "raw", "RGB", 0, 1).convert("RGBA")
+
+# Add box (left, top, right, bottom) to a list of boxes and return the new
+# list. Boxes that overlap or touch the new box are combined with it.
+def _union(boxes, box):
+    while True:
+        left, top, right, bottom = box
+        for b in boxes:
+            if b[0] <= right+1 and left <= b[2]+1 and b[1] <= bottom+1 and top <= b[3]+1:
+                boxes = [o for o in boxes if o is not b]
+                box = (min(left, b[0]), min(top, b[1]), max(right, b[2]), max(bottom, b[3]))
+                break
+        else:
+            return boxes + [box]
+
+# Size of the tiles a non-opaque screen reads back from the framebuffer
+_tile = 32
 
 # An image layer
 class Layer():
@@ -161,12 +378,30 @@ class Layer():
     @property
     def width(self): return self.right-self.left+1
 
+    # The layer's RGBA image. It's created when first used, until then the
+    # layer is filled with a single color. Text and images still being
+    # rendered are drawn first.
+    @property
+    def img(self):
+        if self._pending: self._resolve()
+        if self._img is None: self._img = Image.new("RGBA", (self.width, self.height), self._fill.rgba)
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._pending = []
+        self._img = img
+
     @property
     def height(self): return self.bottom-self.top+1
 
     # Create layer, note coordinates are relative to the parent layer.
     def __init__(self, parent=None, left=None, top=None, right=None, bottom=None, fg=None, bg=None, font=None, style=None, border=None):
         self.parent = parent    # the parent layer
+        self.children = []      # child layers, from bottom to top
+        self.shown = not parent # True once merged, the screen is always shown
+        self.dirty = []         # boxes on the screen that need to be redrawn, only used by the screen
+        if parent: parent.children.append(self)
         self.left = int(left)
         self.top = int(top)
         self.right = int(right)
@@ -178,32 +413,119 @@ class Layer():
         self.borderwidth = int(border or 0)
         self.font = font or _here+"/DejaVuSansMono.ttf"
         self.style = Style(style)
-        self.img = Image.new("RGBA", (self.width, self.height), self.bg.rgba)
+        self._img = None
+        self._fill = self.bg               # the color, until there's an image
+        self._pending = []                 # (future, apply) still being rendered, see _render()
+        self.opaque = self.bg.alpha == 255  # True if every pixel of img is known to be opaque
+        self.blank = self.bg.alpha == 0     # True if every pixel of img is known to be transparent
+        self._damage(0, 0, self.width-1, self.height-1)
         self.border()
 
+    # private, return the box (relative to this layer) of the layer's image,
+    # without creating the image if it doesn't exist yet
+    def _crop(self, left, top, right, bottom):
+        if self._pending: self._resolve()
+        if self._img is None: return Image.new("RGBA", (right-left+1, bottom-top+1), self._fill.rgba)
+        return self._img.crop((left, top, right+1, bottom+1))
+
+    # private, record that the box (relative to this layer) has changed. If
+    # the layer and all its ancestors are shown then the box is clipped,
+    # translated, and added to the screen's dirty list.
+    def _damage(self, left, top, right, bottom):
+        layer = self
+        while True:
+            left, top, right, bottom = max(int(left), 0), max(int(top), 0), min(int(right), layer.width-1), min(int(bottom), layer.height-1)
+            if left > right or top > bottom or not layer.shown: return
+            if not layer.parent: break
+            left, top, right, bottom = left+layer.left, top+layer.top, right+layer.left, bottom+layer.top
+            layer = layer.parent
+        layer.dirty = _union(layer.dirty, (left, top, right, bottom))
+        if len(layer.dirty) > 16:
+            # too fragmented, just use the bounding box
+            layer.dirty = [(min(b[0] for b in layer.dirty), min(b[1] for b in layer.dirty),
+                            max(b[2] for b in layer.dirty), max(b[3] for b in layer.dirty))]
+
+    # private, move the pixels of the box (relative to this layer) down by dy
+    # rows, or up if dy is negative. Pixels moved outside the box are lost,
+    # the rows exposed are unchanged and must be redrawn. If possible the
+    # screen moves the same pixels in the framebuffer, else the box is
+    # damaged.
+    def _scroll(self, left, top, right, bottom, dy):
+        if dy > 0: src, dst = (top, bottom-dy), top+dy
+        else: src, dst = (top-dy, bottom), top
+        if src[0] > src[1]: return # everything was moved out
+        self.img.paste(self.img.crop((left, src[0], right+1, src[1]+1)), (left, dst))
+        screen = self
+        while screen.parent: screen = screen.parent
+        if not (isinstance(screen, Screen) and screen._move(self, left, src[0], right, src[1], dy)):
+            self._damage(left, dst, right, dst + src[1] - src[0])
+
+    # private, call apply(func(*args)). If the screen has a thread pool then
+    # func is run there and apply is called later, in the order queued, when
+    # the image is needed or the screen is displayed. So func must not touch
+    # the layer.
+    def _render(self, apply, func, *args):
+        screen = self
+        while screen.parent: screen = screen.parent
+        if getattr(screen, "pool", None) is None:
+            apply(func(*args))
+        else:
+            self._pending.append((screen.pool.submit(func, *args), apply))
+            if self not in screen.pending: screen.pending.append(self)
+
+    # private, apply everything queued by _render()
+    def _resolve(self):
+        pending, self._pending = self._pending, []
+        for future, apply in pending: apply(future.result())
+
     # draw a border on the layer
     def border(self, width=None, color=None):
         if not width: width=self.borderwidth
         if width:
             color = Color(color or self.fg).rgba
+            if color[3] != 255: self.opaque = False
+            self.blank = False
             draw = Draw.Draw(self.img)
             draw.rectangle((0, 0, self.width-1, self.borderwidth-1), fill=color)                       # across the top
             draw.rectangle((0, 0, self.borderwidth-1, self.height-1), fill=color)                      # down the left
             draw.rectangle((self.width-self.borderwidth, 0, self.width-1, self.height-1), fill=color)  # down the right
             draw.rectangle((0, self.height-self.borderwidth, self.width-1, self.height-1), fill=color) # across the bottom
+            self._damage(0, 0, self.width-1, self.borderwidth-1)
+            self._damage(0, 0, self.borderwidth-1, self.height-1)
+            self._damage(self.width-self.borderwidth, 0, self.width-1, self.height-1)
+            self._damage(0, self.height-self.borderwidth, self.width-1, self.height-1)
         return self
 
     # Clear this layer with specified or current background color (but without
-    # transparency)
+    # transparency), and hide its children
     def clear(self, color=None):
-        self.img = Image.new("RGBA", (self.width, self.height), Color(color or self.bg).rgbx)
+        self._img = None
+        self._pending = []
+        self._fill = Color(color or self.bg)
+        if self._fill.alpha != 255: self._fill = Color("#%02x%02x%02x" % self._fill.rgb)
+        self.opaque = True
+        self.blank = False
+        for c in self.children: c.shown = False
+        self._damage(0, 0, self.width-1, self.height-1)
         return self
 
-    # Merge this layer to parent, possibly recurse all the way to the screen layer
+    # Merge this layer to parent, i.e. show it and raise it above its
+    # siblings, then do the same for each ancestor unless recurse is False.
+    # Nothing is actually composited until the screen is displayed.
     def merge(self, recurse=True):
-        if self.parent:
-            self.parent.img.alpha_composite(self.img, (self.left, self.top))
-            if recurse: self.parent.merge(recurse=True)
+        screen = self
+        while screen.parent: screen = screen.parent
+        layer = self
+        while layer.parent:
+            siblings = layer.parent.children
+            if not layer.shown or siblings[-1] is not layer:
+                siblings.remove(layer)
+                siblings.append(layer)
+                layer.shown = True
+                if not (isinstance(screen, Screen) and screen._blend(layer)):
+                    layer._damage(0, 0, layer.width-1, layer.height-1)
+            if not recurse: break
+            layer = layer.parent
         return self
 
     # Normalize left, top, right, and bottom values relative to this layer.
@@ -236,6 +558,21 @@ class Layer():
                      font=font or self.font, style=style or self.style,
                      border=border)
 
+    # Create a scrolling List child of this layer, see below
+    def list(self, items, rowheight, gap=0, left=0, top=0, right=0, bottom=0, fg=None, bg=None, font=None, style=None, border=None, rowbg=None):
+        left, top, right, bottom = self.normalize(left, top, right, bottom)
+        return List(self, items, rowheight, gap, left=left, top=top, right=right, bottom=bottom,
+                    fg=fg or self.fg, bg=bg or self.bg,
+                    font=font or self.font, style=style or self.style,
+                    border=border, rowbg=rowbg)
+
+    # Create a character Grid child of this layer, see below
+    def grid(self, columns=80, left=0, top=0, right=0, bottom=0, fg=None, bg=None, font=None, style=None):
+        left, top, right, bottom = self.normalize(left, top, right, bottom)
+        return Grid(self, columns, left=left, top=top, right=right, bottom=bottom,
+                    fg=fg or self.fg, bg=bg or self.bg,
+                    font=font or self.font, style=style or self.style)
+
     # Create a sibling of this layer, i.e. by asking parent to create a child with same dimensions
     def sibling(self, fg=None, bg=None, font=None, style=None, border=None):
         return self.parent.child(left=self.left, top=self.top, right=self.right, bottom=self.bottom,
@@ -274,9 +611,7 @@ class Layer():
             else:
                 # Try to determine font's pixels-per-point, this fails
                 # miserably if font is not monospaced.
-                f = Font.truetype(font=self.font, size=2048)
-                scalewidth=2048/f.getsize(" ")[0] # meh
-                scaleheight=2048/f.font.height
+                scalewidth, scaleheight = _scale(self.font)
 
                 if self.style.columns:
                     columns = self.style.columns
@@ -301,9 +636,8 @@ class Layer():
                 if self.style.min: point = min(point, (self.width / self.style.min) * scalewidth)
 
             # set the new point size, note it rounds down
-            f = Font.truetype(font=self.font, size = int(point) or 1)
-            charwidth = f.getsize(" ")[0] # meaningless for proportional fonts
-            charheight = f.font.height
+            point = int(point) or 1
+            charwidth, charheight = _cell(self.font, point)
 
             # get actual columns and rows, but at least one to allow partial display if necessary
             columns = (self.width // charwidth) or 1
@@ -327,13 +661,20 @@ class Layer():
             elif self.style.align.south: yoff = self.height - (charheight * len(text))
             else: yoff = (self.height - (charheight * len(text))) // 2
 
-            d = Draw.Draw(self.img)
-            for l in text:
+            def paste(mask, yoff, fg=self.fg, align=self.style.align):
                 # align horizontal
-                if self.style.align.west: xoff = 0
-                elif self.style.align.east: xoff = self.width - f.getsize(l)[0] + 1
-                else: xoff = (self.width - f.getsize(l)[0] + 1) // 2
-                d.text((xoff, yoff), l, font = f, fill = self.fg.rgba)
+                if align.west: xoff = 0
+                elif align.east: xoff = self.width - mask.width + 1
+                else: xoff = (self.width - mask.width + 1) // 2
+                if mask.width and mask.height:
+                    # paste replaces the alpha, so translucent text leaves holes
+                    if fg.alpha != 255: self.opaque = False
+                    self.img.paste(fg.rgba, (xoff, yoff), mask)
+                    self.blank = False
+                    self._damage(xoff, yoff, xoff + mask.width - 1, yoff + mask.height - 1)
+
+            for l in text:
+                self._render(functools.partial(paste, yoff=yoff), _line, l, self.font, point)
                 yoff += charheight  # next line
 
             self.merge()
@@ -343,30 +684,14 @@ class Layer():
     # Write in mage to this layer, can be an Image(), or a name of an image
     # file, or "-" to read formatted img data from stdin.  The image will be
     # scaled to fit on this layer, if stretch is True will fit exactly else
-    # will be aligned as given (default centered).
+    # will be aligned as given (default centered). Image files are cached
+    # after scaling, see ImageCache.
     def image(self, img, align=None, stretch=None):
 
-        if type(img) is Image:
-           # clone the image
-           img = img.copy()
-        elif img == "-":
-           # read image from stdin
-           img = Image.open(sys.stdin.buffer)
-        else:
-           # read image from file
-           img = Image.open(img)
-        if img.mode != "RGBA": img = img.convert("RGBA")
-
-        # resize as required
-        xoff = yoff = 0
-        if img.width != self.width or img.height != self.height:
-            if stretch:
-                img = img.resize((self.width, self.height))
-            else:
-                aspect=min(self.width/img.width, self.height/img.height)
-                img = img.resize((int(img.width * aspect), int(img.height * aspect)))
-
-                align = Align(align)
+        def paste(img, align=Align(align)):
+            # align as required
+            xoff = yoff = 0
+            if img.width != self.width or img.height != self.height:
                 if align.north:
                     yoff = 0
                 elif align.south:
@@ -380,10 +705,34 @@ class Layer():
                     xoff = self.width - img.width
                 else:
                     xoff = (self.width - img.width) // 2
-        self.img.alpha_composite(img, (xoff, yoff))
+            self.img.alpha_composite(img, (xoff, yoff))
+            self.blank = False
+            self._damage(xoff, yoff, xoff + img.width - 1, yoff + img.height - 1)
+
+        if isinstance(img, Image.Image):
+           # scale a copy of the image
+           self._render(paste, _decode, img.copy(), self.width, self.height, stretch)
+        elif img == "-":
+           # read image from stdin
+           self._render(paste, _decode, Image.open(sys.stdin.buffer), self.width, self.height, stretch)
+        else:
+           # read image from file, or the cache
+           self._render(paste, images.load, img, self.width, self.height, stretch)
         self.merge()
         return self
 
+    # Return z-order of this layer as a tuple of indexes into each ancestor's
+    # children, higher tuples are drawn on top. Return None if it isn't
+    # shown.
+    def zorder(self):
+        order = ()
+        layer = self
+        while layer.parent:
+            if not layer.shown: return None
+            order = (layer.parent.children.index(layer),) + order
+            layer = layer.parent
+        return order
+
     # Return tuple of (left, top, right, bottom) for this layer, relative to the screen.
     # Note this function recurses.
     def box(self):
@@ -396,6 +745,182 @@ class Layer():
             top = self.top
         return left, top, left+self.width-1, top+self.height-1
 
+# A layer showing a vertical list of text rows that can be scrolled, for
+# lists too long to show at once. Items is a sequence of strings, each row is
+# 'rowheight' pixels including a gap of 'gap' pixels below it, and has the
+# given colors and border. The gaps and any space after the last row are bg,
+# rows are rowbg if given, else bg. Only the visible rows are drawn, rendered
+# rows are kept in a cache of the given size, and scrolling moves the existing
+# pixels (in the framebuffer too if bg is opaque) and draws just the rows that
+# are exposed.
+class List(Layer):
+    def __init__(self, parent, items, rowheight, gap=0, left=None, top=None, right=None, bottom=None, fg=None, bg=None, font=None, style=None, border=None, cache=64, rowbg=None):
+        super().__init__(parent, left=left, top=top, right=right, bottom=bottom, fg=fg, bg=bg, font=font, style=style)
+        self.rowbg = Color(rowbg) if rowbg else self.bg
+        self.items = items
+        self.rowheight = int(rowheight)
+        self.gap = int(gap)
+        if self.rowheight - self.gap < 2: raise Exception("Invalid row height %d with gap %d" % (self.rowheight, self.gap))
+        self.rowborder = border
+        self.offset = 0                         # list pixel shown at the top of the layer
+        self.rows = collections.OrderedDict()   # item index -> rendered row image, least recently used first
+        self.cache = cache
+        self._draw(0, self.height-1)
+
+    # private, return the rendered image of the indexed row
+    def _row(self, index):
+        if index in self.rows:
+            self.rows.move_to_end(index)
+        else:
+            self.rows[index] = Layer(None, left=0, top=0, right=self.width-1, bottom=self.rowheight-self.gap-1,
+                                     fg=self.fg, bg=self.rowbg, font=self.font, style=self.style,
+                                     border=self.rowborder).text(str(self.items[index])).img
+            if len(self.rows) > self.cache: self.rows.popitem(last=False)
+        return self.rows[index]
+
+    # private, redraw layer rows 'top' to 'bottom', gaps between and after
+    # the rows are the background color so an opaque list stays opaque
+    def _draw(self, top, bottom):
+        self.img.paste(self.bg.rgba, (0, top, self.width, bottom+1))
+        first = (self.offset + top) // self.rowheight
+        last = min((self.offset + bottom) // self.rowheight, len(self.items)-1)
+        for index in range(first, last+1):
+            row = self._row(index)
+            y = index*self.rowheight - self.offset
+            t, b = max(y, top), min(y+row.height-1, bottom)
+            if t <= b: self.img.alpha_composite(row, (0, t), (0, t-y, row.width, b-y+1))
+        self.blank = False
+        self._damage(0, top, self.width-1, bottom)
+
+    # Redraw the list, e.g. after the items have changed
+    def update(self):
+        self.rows.clear()
+        self.offset = max(0, min(self.offset, len(self.items)*self.rowheight - self.height))
+        self._draw(0, self.height-1)
+        return self
+
+    # Scroll by dy pixels, positive moves the rows up to show later items,
+    # limited by the ends of the list. Returns the distance actually scrolled.
+    def scroll(self, dy):
+        offset = max(0, min(self.offset + int(dy), len(self.items)*self.rowheight - self.height))
+        dy, self.offset = offset - self.offset, offset
+        if abs(dy) >= self.height:
+            self._draw(0, self.height-1)
+        elif dy:
+            # move the rows still shown, in the framebuffer too if the list is
+            # opaque, then draw the rows exposed
+            self._scroll(0, 0, self.width-1, self.height-1, -dy)
+            if dy > 0: self._draw(self.height-dy, self.height-1)
+            else: self._draw(0, -dy-1)
+        return dy
+
+    # Return the index of the item at screen position y, or None
+    def index(self, y):
+        y -= self.box()[1]
+        if not 0 <= y < self.height: return None
+        index = (y + self.offset) // self.rowheight
+        return index if index < len(self.items) else None
+
+    # Scroll if necessary so the indexed row is entirely visible, return its
+    # top relative to the layer
+    def show(self, index):
+        top = index*self.rowheight - self.offset
+        if top < 0: self.scroll(top)
+        elif top + self.rowheight - self.gap > self.height: self.scroll(top + self.rowheight - self.gap - self.height)
+        return index*self.rowheight - self.offset
+
+# A layer showing a grid of character cells in a monospaced font, like a
+# terminal, for log tails and status readouts. Each cell has a character and
+# foreground and background colors. Cells are changed with write(), line()
+# and scroll(), then update() draws just the cells that changed. The point
+# size fits 'columns' characters across the layer, unless the style gives a
+# point size.
+class Grid(Layer):
+    def __init__(self, parent, columns=80, left=None, top=None, right=None, bottom=None, fg=None, bg=None, font=None, style=None):
+        super().__init__(parent, left=left, top=top, right=right, bottom=bottom, fg=fg, bg=bg, font=font, style=style)
+        self.point = int(self.style.point or (self.width / columns) * _scale(self.font)[0]) or 1
+        self.cellwidth, self.cellheight = _cell(self.font, self.point)
+        self.columns = max(self.width // self.cellwidth, 1)
+        self.rows = max(self.height // self.cellheight, 1)
+        self.space = (" ", self.fg.rgba, self.bg.rgba)
+        self.cells = [[self.space] * self.columns for r in range(self.rows)]  # (char, fg, bg) for each cell
+        self.drawn = [list(r) for r in self.cells]   # the cells in the image, None if unknown
+        self.scrolled = 0                               # rows scrolled but not yet drawn
+
+    # Clear all cells to the specified or current background color
+    def clear(self, color=None):
+        super().clear(color)
+        self.space = (" ", self.fg.rgba, Color(color or self.bg).rgbx)
+        self.cells = [[self.space] * self.columns for r in range(self.rows)]
+        self.drawn = [list(r) for r in self.cells]
+        self.scrolled = 0
+        return self
+
+    # Write text to cells starting at row, column, with the given colors or
+    # the layer's. Text that doesn't fit in the row is discarded.
+    def write(self, row, column, text, fg=None, bg=None):
+        if 0 <= row < self.rows:
+            fg = Color(fg or self.fg).rgba
+            bg = Color(bg or self.bg).rgba
+            cells = self.cells[row]
+            for c in text[:max(self.columns - column, 0)]:
+                if column >= 0: cells[column] = (c, fg, bg)
+                column += 1
+        return self
+
+    # Replace the entire row with text, padded with blanks
+    def line(self, row, text, fg=None, bg=None):
+        return self.write(row, 0, text.ljust(self.columns), fg, bg)
+
+    # Scroll up by 'lines' rows, or down if negative, blank rows are exposed
+    def scroll(self, lines=1):
+        lines = max(-self.rows, min(lines, self.rows))
+        blank = [[self.space] * self.columns for r in range(abs(lines))]
+        unknown = [[None] * self.columns for r in range(abs(lines))]
+        if lines > 0:
+            self.cells = self.cells[lines:] + blank
+            self.drawn = self.drawn[lines:] + unknown
+        elif lines < 0:
+            self.cells = blank + self.cells[:lines]
+            self.drawn = unknown + self.drawn[:lines]
+        self.scrolled += lines
+        return self
+
+    # Draw the cells that changed since the last update
+    def update(self):
+        if self.scrolled:
+            # move the pixels of the cells that are still shown
+            self._scroll(0, 0, self.width-1, (self.rows * self.cellheight) - 1, -self.scrolled * self.cellheight)
+            self.scrolled = 0
+        for r in range(self.rows):
+            cells, drawn = self.cells[r], self.drawn[r]
+            if cells == drawn: continue
+            changed = [c for c in range(self.columns) if cells[c] != drawn[c]]
+            y = r * self.cellheight
+            for c in changed:
+                char, fg, bg = cells[c]
+                x = c * self.cellwidth
+                self.img.paste(bg, (x, y, x + self.cellwidth, y + self.cellheight))
+                if bg[3] != 255 or (fg[3] != 255 and char != " "): self.opaque = False
+                if char != " ": self.img.paste(fg, (x, y), _glyph(char, self.font, self.point))
+            self.drawn[r] = list(cells)
+            self._damage(changed[0] * self.cellwidth, y, ((changed[-1] + 1) * self.cellwidth) - 1, y + self.cellheight - 1)
+        self.blank = False
+        return self.merge()
+
+# Threads for Screen() to render text and images with, for utilities that draw
+# several layers at once (e.g. fbmenu's buttons). Only useful with more than
+# one CPU, with one it's 1 and everything is rendered when drawn.
+cpus = min(os.cpu_count() or 1, 8)
+
+# Return a thread pool with the given number of threads, shared by all screens
+_pools = {}
+def _pool(threads):
+    if threads not in _pools:
+        import concurrent.futures
+        _pools[threads] = concurrent.futures.ThreadPoolExecutor(threads, "screen")
+    return _pools[threads]
+
 # All layers are children of the screen layer
 class Screen(Layer):
 
@@ -404,18 +929,205 @@ class Screen(Layer):
             fbdev = None,               # framebuffer device
             bg=None, fg=None,           # default colors
             font=None, style=None,      # default font and style
-            border = None               # add border of given width
+            border = None,              # add border of given width
+            buffering = None,           # "double" to draw offscreen then flip
+            threads = None,             # threads to render text and images, default is 1 i.e. render when drawn
+            profile = None              # file to write profiling results to, or "-" for stderr, see fbprof.py
         ):
 
-        self.fb = fb.Framebuffer(device=fbdev)
+        self.fb = fb.Framebuffer(device=fbdev, buffering=buffering)
+        if profile:
+            # after opening the framebuffer, so its backend is imported
+            try: import fbprof
+            except: from . import fbprof
+            fbprof.enable(profile)
+        threads = threads or 1
+        self.pool = _pool(threads) if threads > 1 else None # renders for layers, see Layer._render()
+        self.pending = []               # layers with renders pending
+        self.flushed = []               # boxes written by the last display()
+        self.moved = []                 # boxes changed in the framebuffer since the last display()
+        self.blends = []                # (layer, box) to blend in the framebuffer by the next display()
         super().__init__(None, left=0, top=0, right=self.fb.width-1, bottom=self.fb.height-1, fg=fg, bg=bg or "black", font=font, style=style, border=border)
+        self.tiles = None               # tiles of the framebuffer not read back yet, see underlay()
         if self.bg.alpha != 255:
-            # install existing framebuffer underneath non-opaque background
-            i = Image.frombytes("RGB", (self.width, self.height), self.fb.unpack(), "raw", "RGB", 0, 1).convert("RGBA")
-            i.alpha_composite(self.img)
-            self.img = i
+            # the existing framebuffer content is underneath the background,
+            # it's read back as needed
+            self.tiles = bytearray(b"\1") * (-(-self.width // _tile) * -(-self.height // _tile))
+            if self.bg.alpha == 0:
+                # the screen is transparent, only what's drawn needs displaying
+                self.dirty = []
+                self.border()
+
+    # Clear the screen, the framebuffer content underneath is no longer needed
+    def clear(self, color=None):
+        self.tiles = None
+        return super().clear(color)
 
-    # Write screen image to the framebuffer
+    # If the screen background isn't opaque, make sure the framebuffer content
+    # underneath the box (left, top, right, bottom) has been read back into
+    # the screen image. This happens as needed when displaying, before
+    # anything is written there.
+    def underlay(self, left, top, right, bottom):
+        if self.tiles is None: return self
+        columns = -(-self.width // _tile)
+        for row in range(max(top, 0) // _tile, min(bottom, self.height-1) // _tile + 1):
+            column, last = max(left, 0) // _tile, min(right, self.width-1) // _tile
+            while column <= last:
+                if not self.tiles[row*columns + column]:
+                    column += 1
+                    continue
+                # read back a run of tiles at once
+                first = column
+                while column <= last and self.tiles[row*columns + column]:
+                    self.tiles[row*columns + column] = 0
+                    column += 1
+                l, t = first * _tile, row * _tile
+                r, b = min(column * _tile, self.width) - 1, min(t + _tile, self.height) - 1
+                under = _readback(self.fb, l, t, r, b)
+                under.alpha_composite(self._crop(l, t, r, b))
+                self.img.paste(under, (l, t))
+        if not any(self.tiles):
+            # all read back
+            self.tiles = None
+            self.opaque = True
+        self.blank = False
+        return self
+
+    # private, return list of (layer, x, y, left, top, right, bottom) for each
+    # shown layer in drawing order, where x and y are the layer's position on
+    # the screen and the box is the visible part, clipped to its ancestors.
+    def _layers(self):
+        layers = []
+        stack = [(self, 0, 0, 0, 0, self.width-1, self.height-1)]
+        while stack:
+            layer, x, y, left, top, right, bottom = stack.pop()
+            box = (max(x, left), max(y, top), min(x+layer.width-1, right), min(y+layer.height-1, bottom))
+            if box[0] > box[2] or box[1] > box[3]: continue
+            layers.append((layer, x, y) + box)
+            stack += [(c, x+c.left, y+c.top) + box for c in reversed(layer.children) if c.shown]
+        return layers
+
+    # private, composite the given layers within the box and return an RGBA
+    # image, or a Color if it's all one opaque color, and True if it's known to
+    # be opaque. Layers beneath the topmost opaque layer covering the entire box
+    # are skipped, as are layers outside the box or without visible pixels.
+    def _compose(self, layers, left, top, right, bottom):
+        start = 0
+        for n in range(len(layers)-1, 0, -1):
+            layer, x, y, l, t, r, b = layers[n]
+            if layer.opaque and l <= left and t <= top and r >= right and b >= bottom:
+                start = n
+                break
+        layer, x, y = layers[start][:3]
+        opaque = layer.opaque or layer is self # the screen is opaque once underlay() is done
+        above = []
+        for a, ax, ay, l, t, r, b in layers[start+1:]:
+            l, t, r, b = max(l, left), max(t, top), min(r, right), min(b, bottom)
+            if l <= r and t <= b and not a.blank: above.append((a, ax, ay, l, t, r, b))
+        if not above and layer._img is None and layer._fill.alpha == 255:
+            # just an opaque color
+            return layer._fill, True
+        img = layer._crop(left-x, top-y, right-x, bottom-y)
+        for layer, x, y, l, t, r, b in above:
+            if layer._img is not None:
+                img.alpha_composite(layer._img, (l-left, t-top), (l-x, t-y, r-x+1, b-y+1))
+            elif layer._fill.alpha == 255:
+                img.paste(layer._fill.rgba, (l-left, t-top, r-left+1, b-top+1))
+            else:
+                img.alpha_composite(Image.new("RGBA", (r-l+1, b-t+1), layer._fill.rgba), (l-left, t-top))
+        return img, opaque
+
+    # private, move the pixels of the box (relative to layer) down by dy rows
+    # in the framebuffer, after the layer moved them in its image. Return
+    # False if that can't be done because the layer isn't opaque, or it's
+    # covered by another layer, or the box hasn't been displayed yet, or
+    # the framebuffer is page flipping. Destination rows that weren't
+    # visible before the move are damaged.
+    def _move(self, layer, left, top, right, bottom, dy):
+        if not layer.opaque or self.fb.flipping: return False
+        layers = self._layers()
+        for n in range(len(layers)):
+            if layers[n][0] is layer: break
+        else:
+            return False # not shown
+        _, x, y, l, t, r, b = layers[n]
+        # the visible source that stays visible
+        sl, st, sr, sb = max(x+left, l), max(y+top, t, t-dy), min(x+right, r), min(y+bottom, b, b-dy)
+        if sl > sr or st > sb: return False
+        box = (sl, min(st, st+dy), sr, max(sb, sb+dy))
+        overlaps = lambda o: o[0] <= box[2] and box[0] <= o[2] and o[1] <= box[3] and box[1] <= o[3]
+        if any(overlaps(o[3:]) for o in layers[n+1:]) or any(overlaps(o) for o in self.dirty): return False
+        self.fb.copy_rect(sl, st, sr-sl+1, sb-st+1, 0, dy)
+        self.moved.append(box)
+        layer._damage(left, top+dy, right, st+dy-y-1)
+        layer._damage(left, sb+dy-y+1, right, bottom+dy)
+        return True
+
+    # private, called when the layer is merged. If it's just a translucent color
+    # (e.g. a highlight) on top of what's already displayed, arrange for the
+    # next display() to blend its box in the framebuffer instead of
+    # compositing it, and return True. Else return False.
+    def _blend(self, layer):
+        if layer._img is None and not layer._pending and 0 < layer._fill.alpha < 255 and not self.fb.flipping and not any(c.shown for c in layer.children):
+            layers = self._layers()
+            if layers[-1][0] is layer:
+                # nothing above it
+                if not any(b[0] is layer for b in self.blends):
+                    self.underlay(*layers[-1][3:])
+                    self.blends.append((layer, layers[-1][3:]))
+                return True
+        return False
+
+    # Composite the dirty parts of the screen and write them to the framebuffer
     def display(self):
-       self.fb.pack(self.img.convert("RGB").tobytes())
-       return self
+        # finish rendering, in the order it was queued
+        for layer in self.pending: layer._resolve()
+        self.pending = []
+        for layer, (left, top, right, bottom) in self.blends:
+            # blend with what's already in the framebuffer, any part that's
+            # also dirty is overwritten below
+            if not layer.shown: continue
+            if layer._img is None:
+                self.fb.blend_rect(layer._fill.rgba, left, top, right-left+1, bottom-top+1)
+                self.moved.append((left, top, right, bottom))
+            else:
+                # drawn on since, composite it
+                self._damage(left, top, right, bottom)
+        self.blends = []
+        if not self.dirty:
+            if self.moved:
+                self.fb.flip(min(b[1] for b in self.moved), max(b[3] for b in self.moved))
+                self.moved = []
+            return self
+        boxes = self.dirty
+        if self.fb.flipping:
+            # the page being drawn is a frame behind, also redraw what was
+            # drawn on the other page
+            for box in self.flushed: boxes = _union(boxes, box)
+        self.flushed = self.dirty
+        if self.tiles is not None:
+            # read back what's about to be overwritten
+            for box in boxes: self.underlay(*box)
+        layers = self._layers()
+        for left, top, right, bottom in boxes:
+            img, opaque = self._compose(layers, left, top, right, bottom)
+            if type(img) is Color:
+                self.fb.fill_rect(img.rgb, left, top, right-left+1, bottom-top+1)
+            elif opaque and self.fb.rawmode in _packable:
+                # PIL can produce native pixels, just copy them. tobytes() is
+                # the one conversion, swizzling to e.g. BGRA costs no more
+                # than copying RGBA out of PIL, which has no zero-copy access
+                # to its rows. Then fbwrite_rect() memcpys each row.
+                self.fb.write_rect(img.tobytes("raw", self.fb.rawmode), left, top, img.width, img.height)
+            else:
+                self.fb.pack_rect(img.convert("RGB").tobytes(), left, top, img.width, img.height)
+        self.fb.flip(min(b[1] for b in boxes + self.moved), max(b[3] for b in boxes + self.moved))
+        self.dirty = []
+        self.moved = []
+        return self
+
+# record hot paths if profiling, see fbprof.py
+if os.environ.get("FB_PROFILE"):
+    try: import fbprof
+    except: from . import fbprof
+    fbprof.instrument(sys.modules[__name__])
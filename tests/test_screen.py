@@ -0,0 +1,91 @@
+# Tests for screen.py, using fake framebuffers. Run with "make test".
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fb, fbfake, screen
+
+# bit shifts of red, green and blue for each 32bpp raw mode
+layouts = {"BGRA": (16, 8, 0), "RGBA": (0, 8, 16), "ARGB": (8, 16, 24), "ABGR": (24, 16, 8)}
+
+class Readback(unittest.TestCase):
+    def tearDown(self):
+        fb.Framebuffer.cache = None
+
+    # the framebuffer content under a transparent screen is read back without
+    # changing it, including the bottom-right tile
+    def test_bottom_right(self):
+        width, height = 400, 300
+        rgb = bytes(n % 251 for n in range(width * height * 3))
+        for backend in ("c", "numpy") if os.path.isfile(fb._fb_bin) else ("numpy",):
+            for rawmode, shifts in layouts.items():
+                with self.subTest(backend=backend, rawmode=rawmode):
+                    fb.backend = backend
+                    f = fbfake.Framebuffer(width, height, 4, *shifts)
+                    self.assertEqual(f.rawmode, rawmode)
+                    f.pack(rgb)
+                    before = f.unpack()
+                    i = screen._readback(f, 368, 288, width-1, height-1)
+                    self.assertEqual(i.tobytes(), screen.Image.frombytes("RGB", (32, 12), bytes(f.unpack_rect(368, 288, 32, 12))).convert("RGBA").tobytes())
+                    fb.Framebuffer.cache = {("/dev/fb0", "single"): f}
+                    s = screen.Screen(bg="transparent", threads=1)
+                    s.child(left=350, top=280, right=width-1, bottom=height-1).text("x")
+                    s.display()
+                    after = f.unpack()
+                    # only the text layer changed
+                    self.assertEqual(after[:280 * width * 3], before[:280 * width * 3])
+                    for y in range(280, height):
+                        row = y * width * 3
+                        self.assertEqual(after[row:row + 350*3], before[row:row + 350*3])
+
+class Compose(unittest.TestCase):
+    def tearDown(self):
+        fb.Framebuffer.cache = None
+
+    # translucent text makes a layer translucent, so what's beneath it still
+    # shows through when composited
+    def test_translucent_text(self):
+        f = fbfake.Framebuffer(200, 120)
+        fb.Framebuffer.cache = {("/dev/fb0", "single"): f}
+        s = screen.Screen(bg="black", threads=1)
+        layers = [s.child(bg="red").merge(), s.child(bg="green", fg="white50").text("Hello").merge(),
+                  s.child(bg="blue80", fg="yellow").text("x").merge()]
+        s.display()
+        expect = screen.Image.new("RGBA", (200, 120), "black")
+        for layer in layers: expect.alpha_composite(layer.img)
+        got = screen.Image.frombytes("RGB", (200, 120), bytes(f.unpack()))
+        worst = max(max(abs(a-b) for a, b in zip(p, q)) for p, q in zip(got.getdata(), expect.convert("RGB").getdata()))
+        self.assertLessEqual(worst, 2)
+
+class Scroll(unittest.TestCase):
+    def tearDown(self):
+        fb.Framebuffer.cache = None
+
+    # scrolling an opaque list moves its pixels in the framebuffer, and the
+    # result is the same as drawing the list at that position
+    def test_list(self):
+        items = ["Item %d" % n for n in range(50)]
+        f = fbfake.Framebuffer(200, 300)
+        fb.Framebuffer.cache = {("/dev/fb0", "single"): f}
+        s = screen.Screen(bg="black", threads=1)
+        menu = s.list(items, 30, 3, top=20, bottom=259, bg="black", rowbg="blue", border=1).merge()
+        self.assertTrue(menu.opaque)
+        s.display()
+        copies = []
+        copy_rect = f.copy_rect
+        f.copy_rect = lambda *args: copies.append(args) or copy_rect(*args)
+        for dy in (7, 20, 45, -12, 300, -5):
+            menu.scroll(dy)
+            s.display()
+        self.assertTrue(copies)
+        scrolled = bytes(f.unpack())
+
+        g = fbfake.Framebuffer(200, 300)
+        fb.Framebuffer.cache = {("/dev/fb0", "single"): g}
+        s = screen.Screen(bg="black", threads=1)
+        menu2 = s.list(items, 30, 3, top=20, bottom=259, bg="black", rowbg="blue", border=1).merge()
+        menu2.scroll(menu.offset)
+        s.display()
+        self.assertEqual(bytes(g.unpack()), scrolled)
+
+if __name__ == "__main__":
+    unittest.main()
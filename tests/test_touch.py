@@ -0,0 +1,28 @@
+# Tests for touch.py. Run with "make test".
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fb, fbfake, screen, touch
+
+class Regions(unittest.TestCase):
+    def tearDown(self):
+        fb.Framebuffer.cache = None
+
+    # layer regions, whose z-order is a tuple, can be mixed with regions that
+    # have the default or a numeric z-order
+    def test_mixed(self):
+        fb.Framebuffer.cache = {("/dev/fb0", "single"): fbfake.Framebuffer(100, 100)}
+        s = screen.Screen(threads=1)
+        a = s.child(left=0, top=0, right=49, bottom=49).merge()
+        b = s.child(left=20, top=20, right=79, bottom=79).merge()
+        r = touch.Regions().add_layer(a).add_layer(b).add((10, 10, 30, 30), "plain").add((60, 60, 90, 90), "high", z=5)
+        self.assertEqual(r.find(5, 5), (a,))
+        self.assertEqual(r.find(45, 45), (b,))
+        self.assertEqual(r.find(25, 25), ("plain",))
+        self.assertEqual(r.find(70, 70), ("high",))
+        self.assertIsNone(r.find(95, 5))
+        a.merge()
+        self.assertEqual(r.find(45, 45), (a,))
+
+if __name__ == "__main__":
+    unittest.main()
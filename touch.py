@@ -1,5 +1,5 @@
 # module to provide touch screen support
-import os, sys, glob, fcntl, struct, select, time
+import os, sys, glob, fcntl, struct, select, time, collections, array, math
 from ctypes import *
 
 # See linux/input.h for more information
@@ -19,6 +19,15 @@ class input_absinfo(Structure):
 EVIOCGABS_X = 0x80184540
 EVIOCGABS_Y = 0x80184541
 
+# ioctl to retrieve multitouch slot information
+EVIOCGABS_MT_SLOT = 0x8018456f
+
+# Multitouch events of interest, see Documentation/input/multi-touch-protocol.rst
+ABS_MT_SLOT = 0x2f
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+
 # ioctl to retrieve supported keys
 EVIOCGBIT_EVKEY_96 = 0x80604521
 
@@ -30,13 +39,135 @@ BTN_STYLUS = 0x14b
 # In order of preference
 buttons = (BTN_TOUCH, BTN_STYLUS, BTN_MOUSE)
 
+# struct input_event {
+#     struct timeval time;  // two longs, so the size depends on the architecture
+#     __u16 type;
+#     __u16 code;
+#     __s32 value;
+# };
+input_event = struct.Struct("llHHi")
+
+# Max events to read at once
+EVENTS = 64
+
+# Index of touchable regions for Touch.select(). Each region has a box, a
+# value to return when it's touched, and a z-order, where the region with the
+# highest z-order wins if they overlap. Regions are kept in a grid of square
+# cells, so finding the one at x, y only looks at the few in its cell.
+class Regions():
+    def __init__(self, boxes=None, size=64):
+        self.size = size    # cell size in pixels
+        self.cells = {}     # (column, row) -> list of region ids
+        self.regions = {}   # region id -> (box, value, z)
+        self.ids = 0
+        if boxes:
+            for box, value in boxes.items(): self.add(box, value)
+
+    # private, return range of cell columns and rows covering box
+    def _cells(self, box):
+        left, top, right, bottom = (int(n) // self.size for n in box)
+        return ((column, row) for row in range(top, bottom+1) for column in range(left, right+1))
+
+    # Add region with box in form [x1, y1, x2, y2]. The z-order is a tuple
+    # (e.g. a layer's zorder), or a number which is treated as a 1-tuple, or a
+    # function that returns either, or None if the region is currently hidden.
+    # Default is (n,) where n counts the regions added, i.e. above those added
+    # so far without a z-order.
+    def add(self, box, value, z=None):
+        self.ids += 1
+        self.regions[self.ids] = (tuple(box), value, (self.ids,) if z is None else z)
+        for cell in self._cells(box): self.cells.setdefault(cell, []).append(self.ids)
+        return self
+
+    # Add a screen.Layer, which returns the value (default is the layer itself)
+    # when touched. Its z-order follows the layer's, so the topmost layer
+    # wins, and it can't be touched while hidden. The layer's box is taken
+    # now, layers don't move once created but if one is changed it must be
+    # removed and added again.
+    def add_layer(self, layer, value=None):
+        return self.add(layer.box(), layer if value is None else value, layer.zorder)
+
+    # Remove all regions with the given value
+    def remove(self, value):
+        for id in [id for id, region in self.regions.items() if region[1] is value or region[1] == value]:
+            for cell in self._cells(self.regions[id][0]): self.cells[cell].remove(id)
+            del self.regions[id]
+        return self
+
+    # Return (value,) for the topmost region containing x, y, or None
+    def find(self, x, y):
+        found = top = None
+        for id in self.cells.get((x // self.size, y // self.size), ()):
+            box, value, z = self.regions[id]
+            if box[0] <= x <= box[2] and box[1] <= y <= box[3]:
+                if callable(z): z = z()
+                if z is None: continue
+                if type(z) is not tuple: z = (z,)
+                if top is None or z > top: found, top = (value,), z
+        return found
+
+# File that remembers which device Touch() found, set environment
+# FB_PROBE_CACHE="" to always search
+probe_cache = os.environ.get("FB_PROBE_CACHE", "/tmp/fbtools-%d.probe" % os.getuid())
+
+# private, return the device path remembered for key if its node hasn't
+# changed since, else None. Or if path is given then remember it. The node is
+# identified by its device number and inode, which change if the device goes
+# away and comes back.
+def _probed(key, path=None):
+    if not probe_cache: return None
+    try:
+        with open(probe_cache) as f: probed = {line.split("\t")[0]: line.rstrip("\n").split("\t")[1:] for line in f}
+    except OSError:
+        probed = {}
+    try:
+        if path is None:
+            path, rdev, ino = probed[key]
+            st = os.stat(path)
+            return path if (st.st_rdev, st.st_ino) == (int(rdev), int(ino)) else None
+        st = os.stat(path)
+        probed[key] = [path, str(st.st_rdev), str(st.st_ino)]
+        tmp = "%s.%d" % (probe_cache, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), "w") as f:
+            for k, v in probed.items(): f.write("\t".join([k] + v) + "\n")
+        os.replace(tmp, probe_cache)
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
 class Touch():
+    cache = None    # if a dict, touch devices are located once and reused (see fbd.py)
+
+    def __new__(cls, width=None, height=None, device=None):
+        if cls.cache is None: return super().__new__(cls)
+        key = (width, height, device)
+        if key not in cls.cache: cls.cache[key] = super().__new__(cls)
+        return cls.cache[key]
+
     def __init__(self, width=None, height=None, device=None):
-        # Locate EV_ABS device with correct X and Y dimensions, return with
-        # the device handle held open
-        for td in glob.glob(device if device else "/dev/input/event*"):
-            fd = open(td, 'rb')
-            try:
+        if hasattr(self, "device"):
+            # reused from the cache, discard any stale events
+            self.close()
+            return
+        # Locate EV_ABS device with correct X and Y dimensions. Try the one
+        # found last time first, if it's still the same device node.
+        key = "%s %s %s" % (width, height, device)
+        found = _probed(key)
+        candidates = glob.glob(device if device else "/dev/input/event*")
+        if found in candidates:
+            candidates.remove(found)
+            candidates.insert(0, found)
+        for td in candidates:
+            if self._probe(td, width, height):
+                if td != found: _probed(key, td)
+                return
+        raise Exception("No touch device found")
+
+    # private, return True if td is an EV_ABS device with correct X and Y
+    # dimensions and a touch button, and initialize for it
+    def _probe(self, td, width, height):
+        try:
+            with open(td, 'rb') as fd:
                 # get absinfo for x and y axis
                 x = input_absinfo()
                 fcntl.ioctl(fd, EVIOCGABS_X, x, True)
@@ -45,87 +176,202 @@ class Touch():
                 # get array of supported keys
                 keys = (c_ubyte * 96)()
                 fcntl.ioctl(fd, EVIOCGBIT_EVKEY_96, keys, True)
-                if x.minimum == 0 and (x.maximum == width if width else x.maximum >= 64):
-                    if y.minimum == 0 and (y.maximum == height if height else y.maximum >= 64):
-                        for button in buttons:
-                            if keys[button//8] & (1 << (button & 7)):
-                                # found a usable device
-                                self.fd = None
-                                self.device = td
-                                self.button = button
-                                self.width = x.maximum
-                                self.height = y.maximum
-                                self.scale_width = None  # these can be set later to scale the results
-                                self.scale_height = None
-                                return
-            except OSError:
-                # ioctl not supported so advance to next
-                pass
-            fd.close()
-        raise Exception("No touch device found")
+                if not (x.minimum == 0 and (x.maximum == width if width else x.maximum >= 64)): return False
+                if not (y.minimum == 0 and (y.maximum == height if height else y.maximum >= 64)): return False
+                for button in buttons:
+                    if keys[button//8] & (1 << (button & 7)): break
+                else:
+                    return False
+                # found a usable device, get number of multitouch slots
+                try:
+                    slots = input_absinfo()
+                    fcntl.ioctl(fd, EVIOCGABS_MT_SLOT, slots, True)
+                    self.nslots = slots.maximum + 1
+                except OSError:
+                    self.nslots = 1
+        except OSError:
+            # ioctl not supported so advance to next
+            return False
+        self.fd = None
+        self.close()
+        self.device = td
+        self.button = button
+        self.width = x.maximum
+        self.height = y.maximum
+        self.scale_width = None  # these can be set later to scale the results
+        self.scale_height = None
+        return True
+
+    # Close the device, it will be reopened when needed and any events
+    # received in the meantime are lost
+    def close(self):
+        if self.fd is not None: os.close(self.fd)
+        self.fd = None
+        self.pending = collections.deque() # decoded events not yet processed
+        self.partial = b''                 # partial event, just in case
+        self.press = self.xabs = self.yabs = None
+        self.time = None                   # kernel time of the last frame, in seconds
+        # multitouch state, tracking id (-1 if none), x and y for each slot
+        self.slots = array.array('i', [-1, 0, 0] * self.nslots)
+        self.slot = 0
+        self.multitouch = False            # True once multitouch events are seen
+        self.deferred = None               # frame for the next contacts()
+        self.reported = {}                 # frame last returned by contacts()
+
+    # private, open the device if not already open
+    def _open(self):
+        if self.fd is None: self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+
+    # private, read all available events (up to EVENTS) and add them to the
+    # pending queue. Return False if there's nothing to read.
+    def _read(self):
+        try:
+            data = os.read(self.fd, input_event.size * EVENTS)
+        except BlockingIOError:
+            return False
+        if not data: return False
+        if self.partial: data = self.partial + data
+        end = len(data) - (len(data) % input_event.size)
+        self.partial = data[end:]
+        self.pending.extend(input_event.iter_unpack(memoryview(data)[:end]))
+        return True
+
+    # private, return x, y scaled if enabled
+    def _scale(self, x, y):
+        if self.scale_width: x = int(x * (self.scale_width/self.width))
+        if self.scale_height: y = int(y * (self.scale_height/self.height))
+        return (x, y)
+
+    # private, process pending events up to the next EV_SYN, which ends a
+    # frame, updating single-touch and multitouch state. Return (x, y) if the
+    # frame is a touch or None if it's a release, True if it's anything else,
+    # or False if the pending events run out first.
+    def _frame(self):
+        while self.pending:
+            sec, usec, type, code, value = self.pending.popleft()
+            if type == 0: # EV_SYN
+                if code: continue                   # only SYN_REPORT ends a frame
+                self.time = sec + (usec / 1000000)
+                press, xabs, yabs = self.press, self.xabs, self.yabs
+                self.press = self.xabs = self.yabs = None
+                if not self.multitouch:
+                    # single-touch device, track it in the first slot
+                    if press is not None: self.slots[0] = 0 if press else -1
+                    if xabs is not None: self.slots[1] = xabs
+                    if yabs is not None: self.slots[2] = yabs
+                if press == 1:
+                    if xabs is not None and yabs is not None: return self._scale(xabs, yabs)
+                elif press == 0:
+                    return None
+                return True
+            elif type == 1 and code == self.button: # EV_KEY and our button
+                self.press = value
+            elif type == 3:                         # EV_ABS
+                if code == 0:                       # ABS_X
+                    self.xabs = value
+                elif code == 1:                     # ABS_Y
+                    self.yabs = value
+                elif code == ABS_MT_SLOT:
+                    self.slot = value
+                    self.multitouch = True
+                elif self.slot < self.nslots and code in (ABS_MT_TRACKING_ID, ABS_MT_POSITION_X, ABS_MT_POSITION_Y):
+                    self.multitouch = True
+                    if code == ABS_MT_TRACKING_ID: self.slots[self.slot*3] = value
+                    elif code == ABS_MT_POSITION_X: self.slots[self.slot*3+1] = value
+                    elif code == ABS_MT_POSITION_Y: self.slots[self.slot*3+2] = value
+        return False
+
+    # private, return True if the pending events include a whole frame
+    def _complete(self):
+        return any(e[2] == 0 and e[3] == 0 for e in self.pending)
+
+    # Return the multitouch contacts as a dict of {tracking id: (x, y)}, empty
+    # when nothing is touching, or False after timeout seconds. Frames
+    # that only move the same contacts are coalesced, so if several are
+    # waiting only the latest is returned. Frame time is in self.time.
+    def contacts(self, timeout=None):
+        if self.deferred is not None:
+            self.reported, self.deferred = self.deferred, None
+            return self.reported
+
+        if timeout is not None:
+            if timeout <= 0: return False
+            timeout += time.monotonic()
+
+        self._open()
+
+        while self._frame() is False:
+            if not self._read():
+                s = select.select([self.fd], [], [], max(0, timeout-time.monotonic()) if timeout else None)
+                if not s[0]: return False # Timeout!
+
+        contacts = self._contacts()
+        if contacts.keys() == self.reported.keys():
+            # just movement, skip to the latest movement already received
+            self._read()
+            while self._complete():
+                self._frame()
+                latest = self._contacts()
+                if latest.keys() != contacts.keys():
+                    # someone touched or let go, don't lose it
+                    self.deferred = latest
+                    break
+                contacts = latest
+        self.reported = contacts
+        return contacts
+
+    # private, return dict of current multitouch contacts
+    def _contacts(self):
+        slots = self.slots
+        return {slots[n]: self._scale(slots[n+1], slots[n+2]) for n in range(0, len(slots), 3) if slots[n] >= 0}
 
     # Return (x, y) on touch or None on release
     # If timeout given, return False after timeout seconds
     # If reset given, close and reopen the device
     def touch(self, timeout=None, reset=False):
-        if reset and self.fd is not None:
-            self.fd.close()
-            self.fd = None
+        if reset: self.close()
 
         if timeout is not None:
             if timeout <= 0: return False
             timeout += time.monotonic()
 
-        if self.fd is None:
-            self.fd = open(self.device, 'rb')
-            os.set_blocking(self.fd.fileno(), False)
-
-        press = xabs = yabs = None
+        self._open()
 
         while True:
-            # It looks like some touch drivers don't support the poll method
-            # correctly? So first try to read a packet in non-blocking mode and
-            # select only if nothing is waiting.
-            while True:
-                packet = self.fd.read(16)
-                if packet:
-                    if len(packet) == 16: break
-                    # Partial packet, maybe the rest is in the pipe?
-                    for x in range(10):
-                        os.sched_yield()
-                        packet += self.fd.read(16-len(packet))
-                        if len(packet) == 16: break
-                    # Ugh, ignore partial packet
-                else:
+            report = self._frame()
+            if report is False:
+                # It looks like some touch drivers don't support the poll
+                # method correctly? So first try to read in non-blocking mode
+                # and select only if nothing is waiting.
+                if not self._read():
                     s = select.select([self.fd], [], [], max(0, timeout-time.monotonic()) if timeout else None)
                     if not s[0]: return False # Timeout!
+            elif report is not True:
+                return report
 
-            # An event packet is 16 bytes:
-            #     struct input_event {
-            #        struct timeval time; // 8 bytes
-            #        __u16 type;
-            #        __u16 code;
-            #        __s32 value;
-            #     };
-            # We ignore the time
-            type, code, value = struct.unpack("8xHHi", packet)
-
-            if type == 0: # EV_SYN
-                if press == 1:
-                    if xabs is not None and yabs is not None:
-                        # scale if enabled
-                        if self.scale_width: xabs = int(xabs * (self.scale_width/self.width))
-                        if self.scale_height: yabs = int(yabs * (self.scale_height/self.height))
-                        return (xabs, yabs)
-                elif press == 0:
-                    return None
-                press = xabs = yabs = None
-            elif type == 1 and code == self.button: # EV_KEY and our button
-                press = value
-            elif type == 3 and code == 0:           # EV_ABS and ABS_X
-                xabs = value
-            elif type == 3 and code == 1:           # EV_ABS and ABS_Y
-                yabs = value
+    # Asynchronously generate (x, y) on touch or None on release, for use with
+    # asyncio, e.g.:
+    #
+    #     async for xy in touch.events(): ...
+    #
+    async def events(self):
+        import asyncio # only if needed, it's slow to import
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._open()
+        fd = self.fd
+        loop.add_reader(fd, ready.set)
+        try:
+            while True:
+                report = self._frame()
+                if report is True: continue
+                if report is not False:
+                    yield report
+                elif not self._read():
+                    ready.clear()
+                    await ready.wait()
+        finally:
+            loop.remove_reader(fd)
 
     # Return true when touch is released, or false on timeout
     def release(self, timeout=None):
@@ -135,18 +381,116 @@ class Touch():
             if xy is None: return True      # release
             if xy is False: return False    # timeout
 
-    # Given dict of {box:value}, where 'box' defines an area in form [x1, y1,
-    # x2, y2], look for a touch in one of the boxes, and return the
-    # corresponding value. Boxes must not overlap.
+    # Given Regions, or a dict of {box:value} where 'box' defines an area in
+    # form [x1, y1, x2, y2], look for a touch in one of the regions, and
+    # return the corresponding value. If regions overlap then the topmost
+    # one is selected, for a dict that's the last one.
     def select(self, boxes, timeout=None):
+        if not isinstance(boxes, Regions): boxes = Regions(boxes)
         if timeout: timeout += time.monotonic()
         while True:
             xy = self.touch(timeout = max(0, timeout-time.monotonic()) if timeout else None)
             if xy is False: return False    # timeout
             if xy:
-                for box, value in boxes.items():
-                    if xy[0] >= box[0] and xy[0] <= box[2] and xy[1] >= box[1] and xy[1] <= box[3]:
-                        return value
+                found = boxes.find(*xy)
+                if found: return found[0]
+
+# A gesture reported by Gestures.gesture(), kind is one of:
+#   "tap"   - touched and released quickly at x, y
+#   "hold"  - touched at x, y for a while without moving
+#   "drag"  - one contact moved to x, y, by dx, dy since the last drag, at
+#             velocity vx, vy pixels per second
+#   "swipe" - released at x, y while dragging fast, dx, dy is the total
+#             movement and vx, vy the velocity
+#   "release" - released at x, y after a hold or a slow drag
+#   "pinch" - two contacts centered at x, y, scale is their distance
+#             relative to when the second one touched
+Gesture = collections.namedtuple("Gesture", "kind x y dx dy vx vy scale", defaults=(0, 0, 0, 0, 1))
+
+# Recognise gestures from a Touch's multitouch contacts
+class Gestures():
+    def __init__(self, touch, slop=10, tap=0.3, hold=0.5, swipe=500):
+        self.touch = touch
+        self.slop = slop        # pixels a contact can move and still be a tap or hold
+        self.tap = tap          # max seconds for a tap
+        self.hold = hold        # seconds before a hold
+        self.swipe = swipe      # min pixels per second for a swipe
+        self.state = None       # None, "down", "hold", "drag", "pinch" or "done"
+        self.queue = collections.deque()
+
+    # Return the next Gesture, or False after timeout seconds
+    def gesture(self, timeout=None):
+        if timeout is not None: timeout += time.monotonic()
+        while not self.queue:
+            wait = None if timeout is None else timeout - time.monotonic()
+            if self.state == "down":
+                # also wait for the hold
+                held = self.start + self.hold - time.monotonic()
+                if wait is None or held < wait: wait = held
+            contacts = self.touch.contacts(timeout=wait) if wait is None or wait > 0 else False
+            if contacts is False:
+                if self.state == "down" and time.monotonic() >= self.start + self.hold:
+                    self.state = "hold"
+                    self.queue.append(Gesture("hold", *self.origin))
+                elif timeout is not None and time.monotonic() >= timeout:
+                    return False
+            else:
+                self._update(contacts, self.touch.time)
+        return self.queue.popleft()
+
+    # private, update state with a frame of contacts at kernel time t
+    def _update(self, contacts, t):
+        points = list(contacts.values())
+        if not points:
+            # everything released
+            if self.state == "down":
+                self.queue.append(Gesture("tap" if time.monotonic() - self.start <= self.tap else "hold", *self.origin))
+            elif self.state == "drag":
+                x, y = self.last
+                if math.hypot(*self.velocity) >= self.swipe:
+                    self.queue.append(Gesture("swipe", x, y, x - self.origin[0], y - self.origin[1], *self.velocity))
+                else:
+                    self.queue.append(Gesture("release", x, y))
+            elif self.state == "hold":
+                self.queue.append(Gesture("release", *self.last))
+            self.state = None
+        elif len(points) == 1:
+            x, y = points[0]
+            if self.state is None:
+                self.state = "down"
+                self.start = time.monotonic()
+                self.origin = self.last = (x, y)
+                self.time = t
+                self.velocity = (0, 0)
+            elif self.state in ("down", "hold", "drag"):
+                if self.state != "drag" and math.hypot(x - self.origin[0], y - self.origin[1]) > self.slop:
+                    self.state = "drag"
+                if self.state == "drag" and (x, y) != self.last:
+                    dt = t - self.time
+                    if dt > 0: self.velocity = ((x - self.last[0]) / dt, (y - self.last[1]) / dt)
+                    self.queue.append(Gesture("drag", x, y, x - self.last[0], y - self.last[1], *self.velocity))
+                self.last = (x, y)
+                self.time = t
+            elif self.state == "pinch":
+                # lost a contact, ignore the rest until released
+                self.state = "done"
+        else:
+            # use the first two contacts
+            (x0, y0), (x1, y1) = points[:2]
+            distance = math.hypot(x1 - x0, y1 - y0) or 1
+            center = ((x0 + x1) // 2, (y0 + y1) // 2)
+            if self.state != "pinch":
+                self.state = "pinch"
+                self.distance = distance
+            else:
+                self.queue.append(Gesture("pinch", *center, scale=distance / self.distance))
+            self.last = center
+
+# record hot paths if profiling, see fbprof.py
+if os.environ.get("FB_PROFILE"):
+    try: import fbprof
+    except: from . import fbprof
+    fbprof.instrument(sys.modules[__name__])
 
 if __name__ == "__main__":
     t = Touch() # Find the first EV_ABS device with X and Y axis and a usable touch button